@@ -1,14 +1,13 @@
 #!env/bin/python
+import argparse
 
-from recommender import train, db, config, queries
+parser = argparse.ArgumentParser(description='Build profiles of the questions users were active on.')
+parser.add_argument('--checkpoint', help='file recording the progress, to resume the run after an interruption')
+args = parser.parse_args()
 
-with db.connection() as conn:
-    cur = conn.cursor()
-    cur.execute(queries.all_user_activity, (config.site_id,))
+from recommender import train, db, config, queries
 
-    for question in cur:
-        topics = train.get_question_topics(question)
-        train.persist_question_topics(question, topics)
+train.create_question_profiles(queries.all_user_activity, (config.site_id,), progress=print, checkpoint=args.checkpoint)
 
 
 db.close()
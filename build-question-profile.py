@@ -1,28 +1,23 @@
 #!env/bin/python
-import sys
+import argparse
 
-if len(sys.argv) < 2:
-    print("No day interval specified.")
-    sys.exit(1)
-try:
-    days = int(sys.argv[1])
-except ValueError:
-    print("Invalid day interval specified; must be a number.")
-    sys.exit(1)
+parser = argparse.ArgumentParser(description='Build question profiles (LDA topics and term vectors).')
+parser.add_argument('days', type=int, help='day interval of questions to profile')
+parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+parser.add_argument('--checkpoint', help='file recording the progress, to resume the run after an interruption')
+args = parser.parse_args()
 
 from recommender import train, db, config, queries
 
-with db.connection() as conn:
-    cur = conn.cursor()
-    cur.execute(queries.all_questions_since, (config.site_id, days, days))
-
-    i = 0
-    for question in cur:
-        topics = train.get_question_topics(question)
-        train.persist_question_topics(question, topics)
-        i+=1
-        if i % 100 == 0:
-            print(i)
+query_args = (config.site_id, args.days, args.days)
+if args.workers > 1:
+    _, failures = train.backfill_question_profiles(
+        queries.all_questions_since, query_args, args.workers, checkpoint=args.checkpoint,
+        progress=lambda count, rate: print('{} ({:.1f} questions/s)'.format(count, rate)))
+    for first_id, last_id, error in failures:
+        print('Failed to profile questions {}-{}: {}'.format(first_id, last_id, error))
+else:
+    train.create_question_profiles(queries.all_questions_since, query_args, progress=print, checkpoint=args.checkpoint)
 
 
 
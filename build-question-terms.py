@@ -0,0 +1,24 @@
+#!env/bin/python
+import sys
+
+if len(sys.argv) < 2:
+    print("No day interval specified.")
+    sys.exit(1)
+try:
+    days = int(sys.argv[1])
+except ValueError:
+    print("Invalid day interval specified; must be a number.")
+    sys.exit(1)
+
+from recommender import train, db, config, queries
+
+# Backfill stored term vectors of questions profiled before they were persisted by the cron jobs
+i = 0
+for questions in train.stream_questions(queries.all_questions_created_since, (config.site_id, days)):
+    train.persist_questions_terms(questions, train.get_questions_tf(questions))
+    i += len(questions)
+    print(i)
+
+
+
+db.close()
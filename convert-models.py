@@ -0,0 +1,17 @@
+#!env/bin/python
+import time
+
+from recommender import models, utils
+
+# Store the LDA and vocabulary models in the memory-mapped format shared by all worker processes
+for model in (models.MODEL_LDA, models.MODEL_VOCAB):
+    models.export(model)
+    print('Exported', model)
+
+for model in (models.MODEL_LDA, models.MODEL_VOCAB):
+    start = time.time()
+    models.load(model)
+    print('Loaded {} in {:.2f}s'.format(model, time.time() - start))
+
+rss, peak = utils.memory_usage()
+print('RSS: {:.1f} MB (peak {:.1f} MB)'.format(rss / 2**20, peak / 2**20))
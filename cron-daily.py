@@ -1,40 +1,31 @@
 #!env/bin/python
-from recommender import train, db, config, queries, utils
-
-def create_question_profiles(query, args):
-    with db.connection() as conn:
-        cur = conn.cursor()
-        cur.execute(query, args)
-
-        i = 0
-        for question in cur:
-            topics = train.get_question_topics(question)
-            train.persist_question_topics(question, topics)
-            i+=1
-        return i
+from recommender import train, db, config, queries, utils, retraining, storage
 
 def run_daily_cron(logger):
     logger.info('Creating question profiles from last 2 days')
-    cnt = create_question_profiles(queries.all_questions_since, (config.site_id, 2, 2))
+    cnt = train.create_question_profiles(queries.all_questions_since, (config.site_id, 2, 2))
     logger.debug('Created %d profiles', cnt)
 
-    logger.info('Creating profiles for all user activities')
-    cnt = create_question_profiles(queries.all_user_activity, (config.site_id,))
+    logger.info('Creating profiles for new user activities')
+    cnt = train.create_activity_question_profiles()
     logger.debug('Created %d profiles', cnt)
 
     logger.info('Retraining daily subscriber user profiles')
-    from recommender.profiles import UserProfile, CommunityProfile
+    from recommender.profiles import CommunityProfile
     with db.connection() as conn:
         cur = conn.cursor()
         cur.execute(queries.daily_subscribers, (config.site_id,))
-        i = 0
-        for uid in cur:
-            user = UserProfile.load(uid[0])
-            user.retrain()
-            user.save()
-            utils.archive_user_profile(user)
-            i+=1
-    logger.debug('Retrained %d user profiles', i)
+        user_ids = [uid[0] for uid in cur]
+    retraining.retrain_users(user_ids, logger)
+
+    # Train the profiles of all other new subscribers, so their first recommendations are personalized
+    logger.info('Training new subscriber user profiles')
+    trained = set(storage.profile_store().ids())
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(queries.subscribers, (config.site_id,))
+        user_ids = [uid[0] for uid in cur if str(uid[0]) not in trained]
+    retraining.retrain_users(user_ids, logger)
 
     # 4) Retrain community user profile
     logger.info('Retraining community profile')
@@ -0,0 +1,18 @@
+#!env/bin/python
+from recommender import db, config, queries, utils, pools
+
+# Rebuild the candidate pools of all sections; run a few times a day
+def run_pools_cron(logger):
+    for section in queries.sections:
+        for freq in pools.WINDOWS:
+            pool = pools.build(section, freq)
+            pools.save(pool)
+            logger.debug('Built %s pool of %s: %d candidates', freq, section, len(pool))
+    db.close()
+
+
+if __name__ == '__main__':
+    logger = utils.setup_logging(config.cron_log_file_pools)
+    logger.info('Building candidate pools')
+    run_pools_cron(logger)
+    logger.info('Candidate pools built')
@@ -1,20 +1,23 @@
 #!env/bin/python
-from recommender import db, config, queries, utils
+from recommender import db, config, queries, utils, retraining, storage, train
 
 def run_weekly_cron(logger):
+    # The daily runs only look at activity added since the last one; activity that became relevant later
+    # (users who became site users, activity on questions imported afterwards) is profiled here
+    logger.info('Creating question profiles for the whole user activity')
+    count = train.create_question_profiles(queries.all_user_activity, (config.site_id,))
+    logger.info('Created %d question profiles', count)
+
     logger.info('Retraining weekly subscriber user profiles')
-    from recommender.profiles import UserProfile
     with db.connection() as conn:
         cur = conn.cursor()
         cur.execute(queries.weekly_subscribers, (config.site_id,))
-        i = 0
-        for uid in cur:
-            user = UserProfile.load(uid[0])
-            user.retrain()
-            user.save()
-            utils.archive_user_profile(user)
-            i+=1
-    logger.debug('Retrained %d user profiles', i)
+        user_ids = [uid[0] for uid in cur]
+    retraining.retrain_users(user_ids, logger)
+
+    logger.info('Compacting profile store and archive')
+    storage.profile_store().compact()
+    storage.profile_archive().compact()
     db.close()
 
 
@@ -0,0 +1,32 @@
+#!env/bin/python
+from pathlib import Path
+from sklearn.externals import joblib
+
+from recommender import config, storage
+from recommender.profiles import UserProfile, CommunityProfile
+
+# Import user profiles saved as files (models/users/*.npz and pickled *.pkl) into the profile store,
+# capping the term matrices of pickled profiles on the way. The files are left in place and can be removed
+# once the migration succeeded.
+model_dir = Path('.') / config.models['dir'] / config.models['user-dir']
+migrated, failed = 0, 0
+files = {}
+for model_file in sorted(model_dir.glob('*.pkl')) + sorted(model_dir.glob('*.npz')):
+    files[model_file.stem] = model_file  # Prefer the already converted file
+
+with storage.profile_store().batch() as store:
+    for name, model_file in sorted(files.items()):
+        try:
+            if model_file.suffix == '.npz':
+                cls = CommunityProfile if name == 'community' else UserProfile
+                user = storage.loads(model_file.read_bytes(), cls)
+            else:
+                user = joblib.load(model_file)
+                user.compact()
+            store.put(user.id, storage.dumps(user))
+            migrated += 1
+        except Exception as e:
+            print('Failed to migrate {}: {}: {}'.format(model_file.name, type(e).__name__, e))
+            failed += 1
+
+print('Migrated {} profiles, {} failed'.format(migrated, failed))
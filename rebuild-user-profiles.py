@@ -1,16 +1,18 @@
 #!env/bin/python
+import sys
+import logging
 
-from recommender.profiles import UserProfile
-from recommender import db, config
+from recommender import db, config, queries, retraining
+
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s - %(message)s')
+workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
 
 with db.connection() as conn:
     cur = conn.cursor()
-    cur.execute('SELECT id FROM users WHERE account_id IS NOT NULL AND site_id = %s', (config.site_id,))
-    for uid in cur:
-        user = UserProfile.load(uid[0])
-        print(user.id)
-        user.retrain()
-        user.save()
+    cur.execute(queries.site_users, (config.site_id,))
+    user_ids = [uid[0] for uid in cur]
+
+retraining.retrain_users(user_ids, logging.getLogger(), workers, archive=False)
 
 
 
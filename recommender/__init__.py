@@ -2,18 +2,66 @@ import requests
 import json
 import math
 import random
+import threading
+from collections import deque
 from datetime import datetime, timedelta
-from pathlib import Path
 from recommender import config
-from sklearn.externals import joblib
 
-from recommender import models, queries, profiles, db, utils
+from recommender import models, queries, profiles, db, utils, storage, pools, background, match_archive
 
 # User profile threshold; If smaller, use community profile
 profile_size_threshold = 5
 rec_lst_size = 5
 
 
+def query_candidates(content_type, section, mode, query_params):
+    # (id, question ID) pairs of a section's candidates, queried directly when there is no candidate pool
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(queries.build_section(section, mode), query_params)
+        results = [res[0] for res in cur]
+        return _with_question_ids(cur, content_type, results)
+
+
+def query_bucket_candidates(content_type, section, buckets, query_params):
+    # {bucket: (id, question ID) pairs} of all tag/topic buckets in one query
+    query_params = dict(query_params, bucket_types=[bucket_type for bucket_type, _ in buckets],
+                        bucket_ids=[bucket_id for _, bucket_id in buckets])
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(queries.build_buckets(section), query_params)
+        rows = cur.fetchall()
+        question_ids = dict(_with_question_ids(cur, content_type, list({id for id, _, _ in rows})))
+
+    candidates = {bucket: [] for bucket in buckets}
+    for id, bucket_type, bucket_id in rows:
+        if id in question_ids:
+            candidates[(bucket_type, bucket_id)].append((id, question_ids[id]))
+    return candidates
+
+
+def _with_question_ids(cur, content_type, results):
+    if content_type != 'answers' or not results:
+        return [(id, id) for id in results]
+    cur.execute(queries.question_answer_index, {'answers': tuple(results)})
+    return [(aid, qid) for qid, aid in cur]
+
+
+def match_candidates(user, content_type, candidates, get_int, get_exp, n=-1):
+    # If questions, match to user and return
+    if content_type == 'questions':
+        return user.match_questions([id for id, _ in candidates], get_int, get_exp, n)
+
+    # If answers, match their questions and return the answers belonging to the matched ones
+    elif content_type == 'answers':
+        qa_index = {qid: aid for aid, qid in candidates}
+        qmatches = user.match_questions(list(qa_index.keys()), get_int, get_exp, n)
+        return [(qa_index[qid], score) for qid, score in qmatches]
+    # Something else? Better return nothing at all
+    else:
+        return []
+
+
 class PersonalizedRecommender:
 
     def __init__(self, user, logger):
@@ -21,7 +69,7 @@ class PersonalizedRecommender:
         self.logger = logger
         logger.debug('Using PersonalizedRecommender')
 
-    def recommend(self, rec_mode, section, since, dupes):
+    def get_candidates(self, rec_mode, section, since, dupes):
         content_type, profile_mode = rec_mode
         get_int = profile_mode == 'interests' or profile_mode == 'both'
         get_exp = profile_mode == 'expertise' or profile_mode == 'both'
@@ -30,124 +78,94 @@ class PersonalizedRecommender:
         tags = self.user.get_tags(5, get_int, get_exp)
         topics = self.user.get_topics(3, get_int, get_exp)
 
-        # Construct query based on section
         duplicates = dupes.get('question' if content_type == 'questions' else 'answer', [0])
-        query = queries.build_section(section)
-        query_params = {
+        pool = pools.find(section, since)
+        if pool is not None:
+            return pool.candidates(since, duplicates, tags, topics, recent=pools.recent(pool))
+
+        self.logger.debug('No candidate pool for %s, querying the section', section)
+        return query_candidates(content_type, section, 'both', {
             'site_id': config.site_id,
             'since': since,
             'dupes': tuple(duplicates if len(duplicates) > 0 else [0]),
-            'tags': tuple(tags),
-            'topics': tuple(topics),
-        }
-
-        # Run query
-        with db.connection() as conn:
-            cur = conn.cursor()
-            cur.execute(query, query_params)
-            results = [res[0] for res in cur]
-
-        # If questions, match to user and return
-        if content_type == 'questions':
-            return self.user.match_questions([profiles.QuestionProfile(qid) for qid in results], get_int, get_exp)
-
-        # If answers, we have some more work
-        elif content_type == 'answers':
-            # Construct question-answer index
-            with db.connection() as conn:
-                cur = conn.cursor()
-                cur.execute(queries.question_answer_index, {'answers': tuple(results)})
-                qa_index = {qid: aid for qid, aid in cur}
-
-            # Match questions to user
-            qlist = [profiles.QuestionProfile(qid) for qid in qa_index.keys()]
-            qmatches = self.user.match_questions(qlist, get_int, get_exp)
-
-            # Return answers belonging to the matched questions
-            return [(qa_index[qid], score) for qid, score in qmatches]
-        # Something else? Better return nothing at all
-        else:
-            return []
+            'tags': list(tags),
+            'topics': list(topics),
+        })
+
+    def recommend(self, rec_mode, section, since, dupes, n=-1, candidates=None):
+        content_type, profile_mode = rec_mode
+        get_int = profile_mode == 'interests' or profile_mode == 'both'
+        get_exp = profile_mode == 'expertise' or profile_mode == 'both'
+
+        if candidates is None:
+            candidates = self.get_candidates(rec_mode, section, since, dupes)
+        return match_candidates(self.user, content_type, candidates, get_int, get_exp, n)
 
 
 
 
 class DiverseRecommender:
 
-    def __init__(self, user, logger):
+    def __init__(self, user, logger, seed=None):
         self.user = user # type: profiles.UserProfile
         self.logger = logger
+        # Bucket selection and interleaving are reproducible for a given seed
+        self.random = random.Random(seed)
         logger.debug('Using DiverseRecommender')
+        # Candidates of the personalized recommendations, fetched once for the fill-up and the control group
+        self._personalized = {}
 
     def get_buckets(self, n, interests, expertise):
-        def split_half(lst):
-            half = max(5, len(lst) // 4)
-            return lst[:half]
+        def top_quarter(key):
+            # The profile rankings are pre-sorted, so only the top of them is touched
+            ids, weights = self.user.get_ranking(key, interests, expertise)
+            half = max(5, len(ids) // 4)
+            ids, weights = ids[:half], weights[:half]
+            return [((key, val), weight) for val, weight in zip(ids.tolist(), (weights / weights.sum()).tolist())]
 
         def normalize(lst):
             total_weight = sum(w for _, w in lst)
             return [(val, w/total_weight) for val, w in lst]
 
-        tags = normalize(split_half(self.user.get_tags(-1, interests, expertise, weights=True)))
-        topics = normalize(split_half(self.user.get_topics(-1, interests, expertise, weights=True)))
-        tags = [(('tags', val), weight) for val, weight in tags]
-        topics = [(('topics', val), weight) for val, weight in topics]
+        return normalize(self.random.sample(top_quarter('tags'), n - 1) + self.random.sample(top_quarter('topics'), 1))
 
-        return normalize(random.sample(tags, n - 1) + random.sample(topics, 1))
-
-    def get_recommendations(self, bucket, section, since, dupes, rec_mode):
-        bucket_type, bucket_id = bucket
-        content_type, profile_mode = rec_mode
-        get_int = profile_mode == 'interests' or profile_mode == 'both'
-        get_exp = profile_mode == 'expertise' or profile_mode == 'both'
-
-        # Construct query based on section and bucket type
+    def get_bucket_candidates(self, buckets, section, since, dupes, content_type):
         duplicates = dupes.get('question' if content_type == 'questions' else 'answer', [0])
-        query = queries.build_section(section, bucket_type)
-        query_params = {
+        pool = pools.find(section, since)
+        if pool is not None:
+            recent = pools.recent(pool)
+            return {(bucket_type, bucket_id): pool.candidates(since, duplicates, recent=recent,
+                                                              **{bucket_type: [bucket_id]})
+                    for bucket_type, bucket_id in buckets}
+
+        return query_bucket_candidates(content_type, section, buckets, {
             'site_id': config.site_id,
             'since': since,
             'dupes': tuple(duplicates if len(duplicates) > 0 else [0]),
-            bucket_type: bucket_id
-        }
+        })
 
-        # Run query
-        with db.connection() as conn:
-            cur = conn.cursor()
-            cur.execute(query, query_params)
-            results = [res[0] for res in cur]
+    def get_recommendations(self, candidates, rec_mode):
+        content_type, profile_mode = rec_mode
+        get_int = profile_mode == 'interests' or profile_mode == 'both'
+        get_exp = profile_mode == 'expertise' or profile_mode == 'both'
 
-        if not results:
+        if not candidates:
             return []
 
-        # If questions, match to user and return
-        if content_type == 'questions':
-            return self.user.match_questions([profiles.QuestionProfile(qid) for qid in results], get_int, get_exp)
-
-        # If answers, we have some more work
-        elif content_type == 'answers':
-            # Construct question-answer index
-            with db.connection() as conn:
-                cur = conn.cursor()
-                cur.execute(queries.question_answer_index, {'answers': tuple(results)})
-                qa_index = {qid: aid for qid, aid in cur}
-
-            # Match questions to user
-            qlist = [profiles.QuestionProfile(qid) for qid in qa_index.keys()]
-            qmatches = self.user.match_questions(qlist, get_int, get_exp)
-
-            # Return answers belonging to the matched questions
-            return [(qa_index[qid], score) for qid, score in qmatches]
-        # Something else? Better return nothing at all
-        else:
-            return []
+        # A bucket never yields more than rec_lst_size results and skips at most rec_lst_size - 1 items
+        # already picked from other buckets, so there is no need to rank beyond that
+        bucket_size = 2 * rec_lst_size
+        return match_candidates(self.user, content_type, candidates, get_int, get_exp, bucket_size)
 
 
-    def get_personalized(self, rec_mode, section, since, dupes, results):
-        content_type = rec_mode[0]
-        dupes.get(content_type[:-1], []).extend([id for id, _ in results])
+    def get_personalized(self, rec_mode, section, since, dupes, results, n=-1):
+        # Personalized recommendations from the candidates of the original dupes, leaving out the given results
         rec = PersonalizedRecommender(self.user, self.logger)
-        return rec.recommend(rec_mode, section, since, dupes)
+        if section not in self._personalized:
+            self._personalized[section] = rec.get_candidates(rec_mode, section, since, dupes)
+        picked = {id for id, _ in results}
+        candidates = [candidate for candidate in self._personalized[section] if candidate[0] not in picked]
+        return rec.recommend(rec_mode, section, since, dupes, n, candidates)
 
 
     def recommend(self, rec_mode, section, since, dupes):
@@ -157,33 +175,36 @@ class DiverseRecommender:
         get_exp = profile_mode == 'expertise' or profile_mode == 'both'
 
         buckets = list(self.get_buckets(rec_lst_size, get_int, get_exp))
-        rec_lists = {}
+        rec_lists = []
         self.logger.debug('Buckets: %d', len(buckets))
+        candidates = self.get_bucket_candidates([bucket for bucket, _ in buckets], section, since, dupes, content_type)
         for bucket, bucket_weight in buckets:
             self.logger.debug('Get recommendations for bucket "%s #%d"', bucket[0],  bucket[1])
-            rec_lists[(bucket, bucket_weight)] = self.get_recommendations(bucket, section, since, dupes, rec_mode)
-
-        total_size = lambda: sum(len(l) for l in rec_lists.values())
-        self.logger.debug('Total results: %d', total_size())
-
-        results, archive, ids = [], [], []
-        while len(results) < rec_lst_size and total_size() > 0:
-            key = utils.weighted_choice(list(rec_lists.keys()))
-            if not key:
-                break
-            if len(rec_lists[key]) > 0:
-                item = rec_lists[key].pop(0)
-                if item[0] not in ids:
-                    ids.append(item[0])
-                    results.append(item)
-                    archive.append((item, key[0]))
-            else:
-                del rec_lists[key]
+            rec_lists.append(deque(self.get_recommendations(candidates[bucket], rec_mode)))
+        self.logger.debug('Total results: %d', sum(len(l) for l in rec_lists))
+
+        # Interleave the buckets: draw a bucket by weight and take its best remaining item, dropping the
+        # buckets that run empty
+        sampler = utils.WeightedSampler([bucket_weight for _, bucket_weight in buckets], self.random)
+        for i, rec_list in enumerate(rec_lists):
+            if not rec_list:
+                sampler.remove(i)
+
+        results, archive, seen = [], [], set()
+        while len(results) < rec_lst_size and len(sampler) > 0:
+            i = sampler.sample()
+            item = rec_lists[i].popleft()
+            if not rec_lists[i]:
+                sampler.remove(i)
+            if item[0] not in seen:
+                seen.add(item[0])
+                results.append(item)
+                archive.append((item, buckets[i][0]))
 
         if len(results) < rec_lst_size:
             self.logger.debug('Not enough results, filling up with non-diversified')
             cnt = rec_lst_size - len(results)
-            more_results = self.get_personalized(rec_mode, section, since, dupes, results)[:cnt]
+            more_results = self.get_personalized(rec_mode, section, since, dupes, results, cnt)
             results.extend(more_results)
             for res in more_results:
                 archive.append((res, ('personalized', None)))
@@ -193,14 +214,70 @@ class DiverseRecommender:
 
 
 
-def recommend(recommender_type, section, rec_mode, freq, uid, dupes, logger):
-    _, profile_mode = rec_mode
-    user = profiles.UserProfile.load(uid)
+_profile_cache = utils.CountingLRUCache(maxsize=config.user_profile.cache_size)
+_profile_cache_lock = threading.Lock()
+_profile_cache_stats = {'hits': 0, 'misses': 0}
+
+def load_profile(uid=None):
+    # Loaded profiles (the community profile if `uid` is None) are kept while their stored version is current
+    key = 'community' if uid is None else uid
+    version = storage.profile_store().version(key)
+    with _profile_cache_lock:
+        entry = _profile_cache.get(key)
+        if entry is not None and version is not None and entry[0] == version:
+            _profile_cache_stats['hits'] += 1
+            return entry[1]
+        _profile_cache_stats['misses'] += 1
+
+    profile = profiles.CommunityProfile.load() if uid is None else profiles.UserProfile.load(uid)
+    if profile.version is not None:
+        with _profile_cache_lock:
+            _profile_cache[key] = (profile.version, profile)
+    return profile
+
+
+def profile_cache_stats():
+    with _profile_cache_lock:
+        return dict(_profile_cache_stats, evictions=_profile_cache.evictions, entries=len(_profile_cache),
+                    size=_profile_cache.maxsize)
+
 
-    if user.iterations == 0:
-        logger.debug('User is untrained')
-        user.train()
-        user.save()
+def queue_training(uid, logger):
+    # Train an untrained user profile on a background thread; the user is claimed in the profile store first,
+    # so only one job across all server processes trains it
+    store = storage.profile_store()
+    if not store.claim_training(uid, config.background.training_claim_timeout):
+        return False
+    if not background.training_executor().submit('train user {}'.format(uid), logger, train_user, uid):
+        store.release_training(uid)
+        return False
+    return True
+
+
+def train_user(uid):
+    try:
+        user = profiles.UserProfile.load(uid)
+        if user.iterations == 0 and not user.load_error:
+            user.train()
+            # Saving bumps the stored version, so the next request loads the trained profile
+            user.save()
+    finally:
+        storage.profile_store().release_training(uid)
+
+
+def recommend(recommender_type, section, rec_mode, freq, uid, dupes, logger, n=-1):
+    # Returns the IDs of the top `n` matches (all if -1); only those are ranked
+    _, profile_mode = rec_mode
+    user = load_profile(uid)
+
+    if user.load_error:
+        # Don't retrain on the request path, the profile is fixed by the next cron run
+        logger.error('Loading profile of user %s failed: %s', uid, user.load_error)
+    elif user.iterations == 0:
+        # Training takes long, so the user gets the community profile until the trained profile is saved
+        logger.debug('User is untrained. Using combined community profile while training in the background')
+        queue_training(uid, logger)
+        user = load_profile()
     else:
         logger.debug('User is on profile iteration #%d', user.iterations)
 
@@ -213,7 +290,7 @@ def recommend(recommender_type, section, rec_mode, freq, uid, dupes, logger):
 
     if profile_size < profile_size_threshold:
         logger.debug('Insufficient profile size. Using combined community profile')
-        user = profiles.CommunityProfile.load()
+        user = load_profile()
 
     now = datetime.now()
 
@@ -223,25 +300,37 @@ def recommend(recommender_type, section, rec_mode, freq, uid, dupes, logger):
         matches, archive = rec.recommend(rec_mode, section, since, dupes)
         archive_matches(uid, archive, section, 'div_' + freq)
 
-        # Control group: Generate personalized recs as well to compare metrics
-        logger.debug('Generating control data using PersonalizedRecommender')
-        _rec = PersonalizedRecommender(user, utils.NonLogger())
-        archive_matches(uid, _rec.recommend(rec_mode, section, since, dupes), section, 'ctl_' + freq)
+        # Control group: Generate personalized recs as well to compare metrics, after the response is sent;
+        # the caller goes on extending the dupes, so the task gets its own copy
+        logger.debug('Queueing control data using PersonalizedRecommender')
+        background.executor().submit('control group', logger, archive_control_group, rec, uid, rec_mode, section,
+                                     since, {key: list(ids) for key, ids in dupes.items()}, freq, n)
     else:
         since = now - timedelta(days=8) if freq == 'w' else now - timedelta(days=2)
         rec = PersonalizedRecommender(user, logger)
-        matches = rec.recommend(rec_mode, section, since, dupes)
+        matches = rec.recommend(rec_mode, section, since, dupes, n)
         archive_matches(uid, matches, section, freq)
 
     return [id for id, score in matches]
 
 
+def recommend_batch(recommender_type, sections, freq, uid, dupes, limit, logger):
+    # Recommend several sections for one user, excluding the results of each section from the following ones
+    dupes = {key: list(ids) for key, ids in dupes.items()}
+    results = {}
+    for section, rec_mode in sections:
+        ids = recommend(recommender_type, section, rec_mode, freq, uid, dupes, logger, limit)[:limit]
+        dupes.setdefault('question' if rec_mode[0] == 'questions' else 'answer', []).extend(ids)
+        results[section] = ids
+    return results
+
+
+def archive_control_group(rec, user_id, rec_mode, section, since, dupes, freq, n=-1):
+    archive_matches(user_id, rec.get_personalized(rec_mode, section, since, dupes, [], n), section, 'ctl_' + freq)
+
+
 def archive_matches(user_id, matches, section, freq):
-    archive_dir = Path('.') / config.archive_dir / '{:%Y-%m-%d}'.format(datetime.now()) / 'matches'
-    if not archive_dir.exists():
-        archive_dir.mkdir(parents=True)
-    filepath = archive_dir / '{}_{}_{}.pkl'.format(freq, user_id, section)
-    joblib.dump(matches, filepath)
+    match_archive.sink().append(user_id, section, freq, matches)
 
 
 def fetch_trivial_recommendations(uid, section, freq, dupes):
@@ -0,0 +1,100 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from recommender import config, db
+
+
+# Work done off the request path (control groups, archiving) by a few threads per process. At most
+# `max_pending` tasks are queued or running; further tasks are rejected and counted instead of piling up.
+class BackgroundExecutor:
+
+    def __init__(self, workers, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def submit(self, name, logger, fn, *args):
+        # Returns False if the task was rejected because the queue is full
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            logger.warning('Background queue full (%d tasks), dropped task: %s', self.max_pending, name)
+            return False
+
+        with self._lock:
+            self.pending += 1
+        try:
+            self._executor.submit(self._run, name, logger, fn, args)
+        except RuntimeError:
+            # The executor is shutting down
+            self._done(failed=True)
+            logger.error('Background task %s could not be scheduled', name)
+            return False
+        return True
+
+    def _run(self, name, logger, fn, args):
+        failed = False
+        try:
+            fn(*args)
+        except Exception:
+            failed = True
+            logger.exception('Background task %s failed', name)
+        finally:
+            # Tasks use the connection of their worker thread, give it back to the pool
+            db.close()
+            self._done(failed)
+
+    def _done(self, failed):
+        with self._lock:
+            self.pending -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self.pending,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+            }
+
+
+_executors = {}
+_executors_pid = None
+_executors_lock = threading.Lock()
+def _get(name, workers, max_pending):
+    # Threads don't survive a fork, so every process starts its own executors
+    global _executors_pid
+    with _executors_lock:
+        if _executors_pid != os.getpid():
+            _executors.clear()
+            _executors_pid = os.getpid()
+        if name not in _executors:
+            _executors[name] = BackgroundExecutor(workers, max_pending)
+        return _executors[name]
+
+
+def executor():
+    return _get('tasks', config.background.workers, config.background.max_pending)
+
+
+def training_executor():
+    # Profile training runs on its own threads, so new users can't hold up or crowd out the other tasks
+    return _get('training', config.background.training_workers, config.background.training_max_pending)
+
+
+def stats():
+    return {'tasks': executor().stats(), 'training': training_executor().stats()}
@@ -7,23 +7,65 @@ DB.host = 'localhost'
 DB.name = 'stackletter'
 DB.user = 'postgres'
 DB.password = ''
+DB.pool_size = 10  # Connections per process
+DB.pool_min_idle = 2  # Connections opened when the pool is created, the others are opened on demand
+DB.pool_timeout = 30  # Seconds to wait for a free connection
+DB.pool_health_check = True  # Run SELECT 1 on every checkout
 
 models = {
     'dir': 'models',
     'lda-topics': 'lda-topics.pkl',
     'term-vocab': 'term-vocab.pkl',
     'user-dir': 'users',
+    'profile-store': 'profiles.sqlite',
+    'mmap-dir': 'mmap',  # Memory-mappable copies of the models, written by convert-models.py
 }
 
 archive_dir = 'archive'
 log_file = 'logs/app.log'
 cron_log_file_daily = 'logs/cron-daily.log'
 cron_log_file_weekly = 'logs/cron-weekly.log'
+cron_log_file_pools = 'logs/cron-pools.log'
 
 rollbar_token = ''
 rollbar_env = 'recommender.production'
 
+user_profile = SimpleNamespace()
+user_profile.max_term_rows = 1000  # Rows of the interests/expertise term matrices kept per user
+user_profile.cache_size = 1000  # Loaded profiles kept in memory by each server process
+
+retraining = SimpleNamespace()
+retraining.workers = 4  # Processes retraining user profiles in the cron jobs
+retraining.chunk_size = 50  # User IDs handed to a worker at a time
+
 question_profile = SimpleNamespace()
 question_profile.lda_threshold_percentile = 25
+question_profile.chunk_size = 2000  # Questions vectorized and inferred as one matrix
+question_profile.watermarks_file = 'activity-watermarks.json'  # In the models dir, see cron-daily.py
+question_profile.watermark_lag = 10000  # Row IDs below every watermark scanned again for rows committed late
 
 term_vocabulary_size = 150000
+
+question_store = SimpleNamespace()
+question_store.memory_budget = 256 * 2**20  # Approximate bytes of hydrated questions kept per process
+question_store.disk_file = 'question-features.sqlite'  # Shared tier in the models dir; None to disable
+question_store.terms_file = 'question-terms.sqlite'  # Precomputed question TF rows in the models dir
+
+candidate_pools = SimpleNamespace()
+candidate_pools.dir = 'pools'  # In the models dir, written by cron-pools.py
+candidate_pools.max_age = 12 * 3600  # Seconds after which a pool is ignored and its section queried directly
+candidate_pools.refresh = 60  # Seconds between live queries for the candidates created since a pool was built
+candidate_pools.overlap = 600  # Seconds before a pool's build time the live query starts
+
+background = SimpleNamespace()
+background.workers = 2  # Threads per server process for the control groups and match archiving
+background.max_pending = 200  # Queued or running tasks per process; further tasks are rejected and counted
+background.training_workers = 1  # Threads per server process training the profiles of new users
+background.training_max_pending = 50  # Queued or running trainings per process
+background.training_claim_timeout = 3600  # Seconds after which the training claim of a user is taken over
+
+match_archive = SimpleNamespace()
+match_archive.flush_interval = 5  # Seconds between writes of the buffered match records
+match_archive.max_buffer = 20000  # Records buffered per process; further ones are dropped and counted
+match_archive.fsync = 'interval'  # 'always' (every write), 'interval' (every fsync_interval seconds) or 'never'
+match_archive.fsync_interval = 60
@@ -1,12 +1,16 @@
+import os
+import time
+import threading
 import psycopg2
+import psycopg2.extensions
+from psycopg2 import pool
 from recommender import config
 
 from flask import g, has_app_context
 
-_database = None
 
-def connect():
-    return psycopg2.connect(
+def _connect_args():
+    return dict(
         host=config.DB.host,
         database=config.DB.name,
         user=config.DB.user,
@@ -15,23 +19,139 @@ def connect():
     )
 
 
+def connect():
+    return psycopg2.connect(**_connect_args())
+
+
+# Thread-safe pool of connections which are reused across requests and checked before being handed out.
+# Callers wait (up to DB.pool_timeout seconds) when all connections are checked out.
+class ConnectionPool:
+
+    def __init__(self, min_idle, size):
+        self._pool = pool.ThreadedConnectionPool(min_idle, size, **_connect_args())
+        # psycopg2 closes returned connections once it holds `minconn` idle ones; keep all of them for reuse
+        # (only `min_idle` are opened upfront, the others when first needed)
+        self._pool.minconn = size
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.size = size
+        self.checkouts = 0
+        self.discarded = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if config.DB.pool_health_check:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def checkout(self):
+        start = time.time()
+        if not self._slots.acquire(timeout=config.DB.pool_timeout):
+            raise pool.PoolError('Timed out waiting for a database connection')
+        waited = time.time() - start
+
+        try:
+            conn = self._pool.getconn()
+            while not self._healthy(conn):
+                self._pool.putconn(conn, close=True)
+                with self._lock:
+                    self.discarded += 1
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return conn
+
+    def release(self, conn):
+        try:
+            if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            self._pool.putconn(conn, close=bool(conn.closed))
+        except psycopg2.Error:
+            self._pool.putconn(conn, close=True)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'checkouts': self.checkouts,
+                'discarded': self.discarded,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+# Connections inherited over a fork stay referenced: deallocating them would terminate the parent's sessions
+_inherited = []
+
+def get_pool():
+    # Every process gets its own pool
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            if _pool is not None:
+                _inherited.append(_pool)
+            _pool = ConnectionPool(config.DB.pool_min_idle, config.DB.pool_size)
+            _pool_pid = os.getpid()
+        return _pool
+
+
 def connection():
-    global _database
     if has_app_context():
         db = getattr(g, '_database', None)
         if db is None:
-            db = g._database = connect()
+            db = g._database = get_pool().checkout()
         return db
     else:
-        if _database is None:
-            _database = connect()
-        return _database
+        # Outside of Flask every thread holds its own connection until close()
+        if getattr(_local, 'pid', None) != os.getpid():
+            _inherited.append(getattr(_local, 'database', None))
+            _local.database, _local.pid = None, os.getpid()
+        if _local.database is None:
+            _local.database = get_pool().checkout()
+        return _local.database
 
 def close():
     if has_app_context():
         db = getattr(g, '_database', None)
         if db is not None:
-            db.close()
+            g._database = None
+            get_pool().release(db)
     else:
-        if _database is not None:
-            _database.close()
+        db = getattr(_local, 'database', None)
+        if db is not None and getattr(_local, 'pid', None) == os.getpid():
+            _local.database = None
+            get_pool().release(db)
+
+
+def reset():
+    # Forget the connections inherited from a parent process without closing them under the parent's feet
+    global _pool
+    with _pool_lock:
+        _inherited.append(_pool)
+        _pool = None
+    _inherited.append(getattr(_local, 'database', None))
+    _local.database = None
+
+
+def stats():
+    return get_pool().stats()
@@ -0,0 +1,159 @@
+import pickle
+import hashlib
+import threading
+import numpy
+import scipy.sparse as sparse
+from pathlib import Path
+
+from recommender import config, utils, storage
+
+
+# sqlite tier of the question feature store, pickled profiles keyed by question ID with their version
+class _QuestionFeatureFile(storage.SqliteStore):
+    schema = (
+        'CREATE TABLE IF NOT EXISTS question_features (id INTEGER PRIMARY KEY, version TEXT NOT NULL, '
+        'data BLOB NOT NULL)',
+    )
+
+    # (question ID, version, pickled profile) rows of the given question IDs
+    def get_many(self, ids):
+        rows = []
+        with self._lock:
+            conn = self._connection()
+            for i in range(0, len(ids), 900):
+                chunk = ids[i:i + 900]
+                rows += conn.execute('SELECT id, version, data FROM question_features WHERE id IN ({})'
+                                     .format(','.join('?' * len(chunk))), chunk).fetchall()
+        return rows
+
+    def put_many(self, rows):
+        self._write('INSERT OR REPLACE INTO question_features (id, version, data) VALUES (?, ?, ?)', rows)
+
+
+# Two-tier store of hydrated question profiles keyed by (question ID, version). The memory tier is an LRU
+# bounded by an estimated byte budget and private to the process; the optional sqlite tier is shared by all
+# processes (server workers, cron jobs) running from the same directory.
+class QuestionFeatureStore:
+
+    def __init__(self, memory_budget, disk_file=None):
+        self.memory = utils.CountingLRUCache(maxsize=memory_budget, getsizeof=lambda entry: entry.memory_size())
+        self.disk = _QuestionFeatureFile(disk_file) if disk_file else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+
+    def _put_memory(self, key, profile):
+        try:
+            self.memory[key] = profile
+        except ValueError:
+            pass  # Larger than the whole budget; keep it on disk only
+
+    # Look up profiles for a {question ID: version} mapping; returns {question ID: profile} of the hits
+    def get_many(self, versions):
+        found = {}
+        with self._lock:
+            for qid, version in versions.items():
+                profile = self.memory.get((qid, version))
+                if profile is not None:
+                    found[qid] = profile
+            self.hits += len(found)
+
+            remaining = [qid for qid in versions if qid not in found]
+            if remaining and self.disk is not None:
+                for qid, version, data in self.disk.get_many(remaining):
+                    if version == versions[qid]:
+                        found[qid] = profile = pickle.loads(data)
+                        self._put_memory((qid, version), profile)
+                        self.disk_hits += 1
+
+            self.misses += len(versions) - len(found)
+        return found
+
+    # Store profiles from a {(question ID, version): profile} mapping in both tiers
+    def put_many(self, profiles):
+        with self._lock:
+            for key, profile in profiles.items():
+                self._put_memory(key, profile)
+            if self.disk is not None and profiles:
+                self.disk.put_many([(qid, version, pickle.dumps(profile, pickle.HIGHEST_PROTOCOL))
+                                    for (qid, version), profile in profiles.items()])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.memory.evictions,
+                'entries': len(self.memory),
+                'memory_used': self.memory.currsize,
+                'memory_budget': self.memory.maxsize,
+            }
+
+
+def text_digest(title, body):
+    # Identifies the text a term vector was computed from, so that edited questions are vectorized again
+    return hashlib.sha1('{}\0{}'.format(title or '', body or '').encode('utf-8')).hexdigest()
+
+
+# Persistent store of question term-frequency rows, written by the question-profile cron jobs so that the
+# serving path never has to run the vectorizer. Each row is kept as packed column indices and counts, with
+# the digest of the question text it was computed from.
+class TermVectorStore(storage.SqliteStore):
+    schema = (
+        # Rows of the first version of the table have no text digest and can't be told apart from stale ones
+        'DROP TABLE IF EXISTS question_terms',
+        'CREATE TABLE IF NOT EXISTS term_vectors (id INTEGER PRIMARY KEY, digest TEXT NOT NULL, '
+        'n_features INTEGER NOT NULL, indices BLOB NOT NULL, counts BLOB NOT NULL)',
+    )
+
+    # Store the rows of a CSR term matrix under the given (question ID, text digest) pairs
+    def put_many(self, keys, matrix):
+        matrix = sparse.csr_matrix(matrix)
+        rows = []
+        for i, (qid, digest) in enumerate(keys):
+            start, end = matrix.indptr[i], matrix.indptr[i + 1]
+            rows.append((qid, digest, matrix.shape[1],
+                         matrix.indices[start:end].astype(numpy.int32).tobytes(),
+                         matrix.data[start:end].astype(numpy.int32).tobytes()))
+        self._write('INSERT OR REPLACE INTO term_vectors (id, digest, n_features, indices, counts) '
+                    'VALUES (?, ?, ?, ?, ?)', rows)
+
+    # Look up term vectors for a {question ID: text digest} mapping; returns {question ID: 1 x n_features CSR row}
+    # of the questions whose stored vector was computed from the same text
+    def get_many(self, digests):
+        ids = list(digests)
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            for i in range(0, len(ids), 900):
+                chunk = ids[i:i + 900]
+                rows = conn.execute('SELECT id, digest, n_features, indices, counts FROM term_vectors WHERE id IN ({})'
+                                    .format(','.join('?' * len(chunk))), chunk)
+                for qid, digest, n_features, indices, counts in rows:
+                    if digest != digests[qid]:
+                        continue
+                    indices = numpy.frombuffer(indices, dtype=numpy.int32)
+                    counts = numpy.frombuffer(counts, dtype=numpy.int32).astype(numpy.int64)
+                    found[qid] = sparse.csr_matrix((counts, indices, [0, len(indices)]), shape=(1, n_features))
+        return found
+
+
+_question_store = None
+def question_store():
+    global _question_store
+    if _question_store is None:
+        disk_file = None
+        if config.question_store.disk_file:
+            disk_file = Path('.') / config.models['dir'] / config.question_store.disk_file
+        _question_store = QuestionFeatureStore(config.question_store.memory_budget, disk_file)
+    return _question_store
+
+
+_term_store = None
+def term_store():
+    global _term_store
+    if _term_store is None:
+        _term_store = TermVectorStore(Path('.') / config.models['dir'] / config.question_store.terms_file)
+    return _term_store
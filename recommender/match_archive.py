@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import atexit
+import threading
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+from recommender import config
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+def _to_json(value):
+    # numpy scalars (scores, IDs)
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+# Append-only daily log of the matches returned by the recommenders. Records are buffered in memory and written
+# by a background thread to archive/<day>/matches-<pid>.jsonl, one JSON object per line; each process writes
+# its own files, so no locking between processes is needed.
+class MatchArchive:
+
+    def __init__(self, directory, flush_interval, max_buffer, fsync='interval', fsync_interval=60):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: {}'.format(fsync))
+        self.directory = Path(directory)
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._last_fsync = time.time()
+        self.appended = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def _start(self):
+        # Threads don't survive a fork: a forked process drops the inherited buffer and starts its own writer
+        if self._pid != os.getpid():
+            self._buffer = []
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='match-archive', daemon=True)
+            self._thread.start()
+
+    def append(self, user_id, section, freq, matches):
+        now = datetime.now()
+        record = {'time': now.isoformat(), 'user_id': user_id, 'section': section, 'freq': freq, 'matches': matches}
+        with self._cond:
+            self._start()
+            if len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                return False
+            self._buffer.append(('{:%Y-%m-%d}'.format(now), record))
+            self.appended += 1
+            if len(self._buffer) >= self.max_buffer // 2:
+                self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                if self._pid != os.getpid():
+                    return  # Records inherited over a fork belong to the parent
+                records, self._buffer = self._buffer, []
+            if not records:
+                return
+
+            days = {}
+            for day, record in records:
+                days.setdefault(day, []).append(record)
+
+            sync = self.fsync == 'always' or (self.fsync == 'interval' and
+                                              time.time() - self._last_fsync >= self.fsync_interval)
+            for day, day_records in days.items():
+                try:
+                    self._write(day, day_records, sync)
+                    with self._cond:
+                        self.written += len(day_records)
+                except (OSError, TypeError, ValueError):
+                    traceback.print_exc()
+                    with self._cond:
+                        self.errors += 1
+                        self.dropped += len(day_records)
+            if sync:
+                self._last_fsync = time.time()
+
+    def _write(self, day, records, sync):
+        path = self.directory / day / 'matches-{}.jsonl'.format(os.getpid())
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        lines = ''.join(json.dumps(record, default=_to_json) + '\n' for record in records)
+        with open(str(path), 'a') as f:
+            f.write(lines)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def stats(self):
+        with self._cond:
+            return {
+                'buffered': len(self._buffer),
+                'appended': self.appended,
+                'written': self.written,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'fsync': self.fsync,
+            }
+
+
+def read(day, directory=None, freq=None, section=None):
+    # Archived match records of a day (a date or 'YYYY-MM-DD'), optionally of one frequency tag (e.g. 'div_d')
+    # or section; tuples in the matches come back as lists
+    if not isinstance(day, str):
+        day = '{:%Y-%m-%d}'.format(day)
+    day_dir = Path(directory or Path('.') / config.archive_dir) / day
+    for path in sorted(day_dir.glob('matches-*.jsonl')):
+        with open(str(path)) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if (freq is None or record['freq'] == freq) and (section is None or record['section'] == section):
+                    yield record
+
+
+_sink = None
+_sink_lock = threading.Lock()
+def sink():
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = MatchArchive(Path('.') / config.archive_dir, config.match_archive.flush_interval,
+                                 config.match_archive.max_buffer, config.match_archive.fsync,
+                                 config.match_archive.fsync_interval)
+            # Write what is left in the buffer when the process exits
+            atexit.register(_sink.flush)
+        return _sink
+
+
+def stats():
+    return sink().stats()
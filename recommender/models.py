@@ -2,21 +2,94 @@
 # from sklearn.decomposition import LatentDirichletAllocation
 from sklearn.externals import joblib
 from pathlib import Path
+import copy
+import time
 import re
+import numpy
+import scipy.sparse as sparse
 
 from recommender import config
 
 MODEL_LDA = 'lda-topics'
 MODEL_VOCAB = 'term-vocab'
 
+# Models stored in a memory-mappable format are shared read-only by all processes using them
+class MappedVocabulary:
+
+    def __init__(self, vectorizer, terms, columns):
+        self.vectorizer = vectorizer  # CountVectorizer without its vocabulary, used for tokenization only
+        self.terms = terms  # Sorted UTF-8 encoded terms
+        self.columns = columns  # Column index of each term
+        self._analyze = vectorizer.build_analyzer()
+
+    def transform(self, documents):
+        indptr, indices = [0], []
+        max_length = self.terms.dtype.itemsize
+        for document in documents:
+            tokens = [t for t in (token.encode('utf-8') for token in self._analyze(document)) if len(t) <= max_length]
+            tokens = numpy.array(tokens, dtype=self.terms.dtype)
+            positions = numpy.searchsorted(self.terms, tokens).clip(max=len(self.terms) - 1)
+            found = self.terms[positions] == tokens
+            indices.append(self.columns[positions[found]])
+            indptr.append(indptr[-1] + int(found.sum()))
+
+        indices = numpy.concatenate(indices) if indices else numpy.array([], dtype=numpy.int32)
+        tf = sparse.csr_matrix((numpy.ones(len(indices), dtype=numpy.int64), indices, indptr),
+                               shape=(len(indptr) - 1, len(self.terms)))
+        tf.sum_duplicates()
+        return tf
+
+
+def _mapped_dir(model):
+    return Path('.') / config.models['dir'] / config.models['mmap-dir'] / model
+
+
+def export(model):
+    # Write a model in the memory-mappable format picked up by load()
+    instance = joblib.load(Path('.') / config.models['dir'] / config.models[model])
+    model_dir = _mapped_dir(model)
+    if not model_dir.exists():
+        model_dir.mkdir(parents=True)
+
+    if model == MODEL_VOCAB:
+        terms = sorted((term.encode('utf-8'), column) for term, column in instance.vocabulary_.items())
+        numpy.save(str(model_dir / 'terms.npy'), numpy.array([term for term, _ in terms]))
+        numpy.save(str(model_dir / 'columns.npy'), numpy.array([column for _, column in terms], dtype=numpy.int32))
+        vectorizer = copy.copy(instance)
+        vectorizer.vocabulary_, vectorizer.stop_words_ = None, None
+        joblib.dump(vectorizer, model_dir / 'vectorizer.pkl')
+    else:
+        joblib.dump(instance, model_dir / 'model.pkl')
+
+
+def _load_mapped(model, model_dir):
+    if model == MODEL_VOCAB:
+        return MappedVocabulary(joblib.load(model_dir / 'vectorizer.pkl'),
+                                numpy.load(str(model_dir / 'terms.npy'), mmap_mode='r'),
+                                numpy.load(str(model_dir / 'columns.npy'), mmap_mode='r'))
+    return joblib.load(model_dir / 'model.pkl', mmap_mode='r')
+
+
 _models = {}
+_load_stats = {}
 def load(model):
     if model in _models:
         return _models[model]
 
-    _models[model] = joblib.load(Path('.') / config.models['dir'] / config.models[model])
+    start = time.time()
+    model_dir = _mapped_dir(model)
+    mapped = model_dir.exists()
+    if mapped:
+        _models[model] = _load_mapped(model, model_dir)
+    else:
+        _models[model] = joblib.load(Path('.') / config.models['dir'] / config.models[model])
+    _load_stats[model] = {'load_time': time.time() - start, 'mapped': mapped}
     return _models[model]
 
 
+def stats():
+    return dict(_load_stats)
+
+
 def process_question(title, body):
     return "{} {}".format(title, re.sub(r'[\n\r\t ]+', ' ',re.sub(r'<[^<]+?>|&[\w\\]+;', '', body)))
@@ -0,0 +1,228 @@
+import io
+import os
+import time
+import threading
+import traceback
+import numpy
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from recommender import config, db, queries
+
+# Days of candidates kept per newsletter frequency
+WINDOWS = {'d': 2, 'w': 8}
+
+
+# Inverted index from tag or topic IDs to the sorted pool rows of the questions having them
+class _Postings:
+
+    def __init__(self, rows, keys):
+        order = numpy.lexsort((rows, keys))
+        self.keys, starts = numpy.unique(keys[order], return_index=True)
+        self.offsets = numpy.append(starts, len(order))
+        self.rows = rows[order]
+
+    def lookup(self, keys):
+        # Sorted union of the rows of all keys
+        keys = numpy.asarray(list(keys), dtype=self.keys.dtype)
+        positions = numpy.searchsorted(self.keys, keys).clip(max=max(len(self.keys) - 1, 0))
+        positions = positions[self.keys[positions] == keys] if len(self.keys) else positions[:0]
+        postings = [self.rows[self.offsets[p]:self.offsets[p + 1]] for p in positions]
+        return numpy.unique(numpy.concatenate(postings)) if postings else numpy.array([], dtype=numpy.int64)
+
+
+# All candidates of one section within a frequency window, in section order, with the tags and topics of their
+# questions. Pools are built by cron-pools.py a few times a day and filtered per request in memory; the candidates
+# created since a pool was built are merged in from a small live pool refreshed in the background (see recent()).
+class CandidatePool:
+
+    def __init__(self, arrays):
+        self.section = str(arrays['section'])
+        self.freq = str(arrays['freq'])
+        self.since = float(arrays['since'])
+        self.built_at = float(arrays['built_at'])
+        self.ids = arrays['ids']
+        self.question_ids = arrays['question_ids']
+        # Sort key of the section (score or comment count) and creation time, ordered as in queries.sections
+        self.keys = arrays['keys']
+        self.created = arrays['created']
+        # (row, tag) and (row, topic) pairs, indexed when the pool is loaded
+        self.tag_rows, self.tag_ids = arrays['tag_rows'], arrays['tag_ids']
+        self.topic_rows, self.topic_ids = arrays['topic_rows'], arrays['topic_ids']
+        self.tag_index = _Postings(self.tag_rows, self.tag_ids)
+        self.topic_index = _Postings(self.topic_rows, self.topic_ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _rows(self, since, duplicates, tags, topics, limit):
+        # Rows are in section order, so only matching rows are touched
+        rows = numpy.union1d(self.tag_index.lookup(tags), self.topic_index.lookup(topics)).astype(numpy.int64)
+        rows = rows[self.created[rows] > since.timestamp()]
+        if len(duplicates):
+            rows = rows[~numpy.isin(self.ids[rows], list(duplicates))]
+        return rows[:limit]
+
+    def candidates(self, since, duplicates, tags=(), topics=(), limit=500, recent=None):
+        # (id, question ID) pairs of the first `limit` candidates created after `since` with any of the tags
+        # or topics, leaving out the duplicates; candidates of the `recent` pool replace and extend the pool's own
+        rows = self._rows(since, duplicates, tags, topics, limit)
+        if recent is None:
+            return list(zip(self.ids[rows].tolist(), self.question_ids[rows].tolist()))
+
+        recent_rows = recent._rows(since, duplicates, tags, topics, limit)
+        key_sign, created_sign = queries.order_signs(self.section)
+        merged = {id: (key_sign * key, created_sign * created, id, qid)
+                  for pool, pool_rows in ((self, rows), (recent, recent_rows))
+                  for id, qid, key, created in zip(pool.ids[pool_rows].tolist(), pool.question_ids[pool_rows].tolist(),
+                                                   pool.keys[pool_rows].tolist(), pool.created[pool_rows].tolist())}
+        return [(id, qid) for _, _, id, qid in sorted(merged.values())[:limit]]
+
+    def stats(self):
+        return {'candidates': len(self.ids), 'tags': len(self.tag_index.keys), 'topics': len(self.topic_index.keys),
+                'since': self.since, 'age': time.time() - self.built_at}
+
+
+def _pool_path(section, freq):
+    return Path('.') / config.models['dir'] / config.candidate_pools.dir / '{}_{}.npz'.format(section, freq)
+
+
+def build(section, freq, since=None):
+    # Pool of the frequency window, or of everything created after `since`
+    built_at = datetime.now()
+    since = since or built_at - timedelta(days=WINDOWS[freq])
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(queries.build_pool(section), {'site_id': config.site_id, 'since': since, 'dupes': (0,)})
+        rows = [(id, key, created, qid) for id, key, created, qid in cur if qid is not None]
+
+        rows_of = defaultdict(list)
+        for row, (_, _, _, qid) in enumerate(rows):
+            rows_of[qid].append(row)
+        cur.execute(queries.user_profile['questions_get_tags'], (list(rows_of),))
+        tags = [(row, tag) for qid, tag in cur for row in rows_of[qid]]
+        cur.execute(queries.user_profile['questions_get_topics'], (list(rows_of),))
+        topics = [(row, topic) for qid, topic, _ in cur for row in rows_of[qid]]
+
+    return CandidatePool({
+        'section': numpy.array(section),
+        'freq': numpy.array(freq),
+        'since': numpy.float64(since.timestamp()),
+        'built_at': numpy.float64(built_at.timestamp()),
+        'ids': numpy.array([id for id, _, _, _ in rows], dtype=numpy.int64),
+        'question_ids': numpy.array([qid for _, _, _, qid in rows], dtype=numpy.int64),
+        'keys': numpy.array([key for _, key, _, _ in rows], dtype=numpy.float64),
+        'created': numpy.array([created.timestamp() for _, _, created, _ in rows], dtype=numpy.float64),
+        'tag_rows': numpy.array([row for row, _ in tags], dtype=numpy.int64),
+        'tag_ids': numpy.array([tag for _, tag in tags], dtype=numpy.int64),
+        'topic_rows': numpy.array([row for row, _ in topics], dtype=numpy.int64),
+        'topic_ids': numpy.array([topic for _, topic in topics], dtype=numpy.int64),
+    })
+
+
+def save(pool):
+    # Replace the pool file atomically, server processes reload it when they see the new mtime
+    path = _pool_path(pool.section, pool.freq)
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True)
+    buffer = io.BytesIO()
+    numpy.savez(buffer, section=numpy.array(pool.section), freq=numpy.array(pool.freq),
+                since=numpy.float64(pool.since), built_at=numpy.float64(pool.built_at), ids=pool.ids,
+                question_ids=pool.question_ids, keys=pool.keys, created=pool.created, tag_rows=pool.tag_rows,
+                tag_ids=pool.tag_ids, topic_rows=pool.topic_rows, topic_ids=pool.topic_ids)
+    tmp_path = path.with_suffix('.tmp')
+    with open(str(tmp_path), 'wb') as f:
+        f.write(buffer.getvalue())
+    os.replace(str(tmp_path), str(path))
+
+
+def load(path):
+    with numpy.load(str(path)) as archive:
+        return CandidatePool({key: archive[key] for key in archive.files})
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+def get(section, freq):
+    # Current pool of a section, or None if it was never built or is older than candidate_pools.max_age
+    path = _pool_path(section, freq)
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        return None
+
+    with _pools_lock:
+        entry = _pools.get((section, freq))
+        if entry is None or entry[0] != mtime:
+            try:
+                entry = _pools[(section, freq)] = (mtime, load(path))
+            except (OSError, ValueError, KeyError):
+                return None
+
+    pool = entry[1]
+    if time.time() - pool.built_at > config.candidate_pools.max_age:
+        return None
+    return pool
+
+
+_recent = {}
+_refreshing = set()
+# Time of the next rebuild of a live pool whose last rebuild failed
+_retry_at = {}
+_recent_pid = None
+_recent_lock = threading.Lock()
+def recent(pool):
+    # Live pool of the candidates created since `pool` was built, or None until it is first built. It is rebuilt
+    # on a background thread every candidate_pools.refresh seconds, and the previous one is served meanwhile.
+    global _recent_pid
+    key = (pool.section, pool.freq)
+    with _recent_lock:
+        if _recent_pid != os.getpid():
+            # Threads don't survive a fork, so a rebuild started by the parent would never finish
+            _recent.clear()
+            _refreshing.clear()
+            _retry_at.clear()
+            _recent_pid = os.getpid()
+        entry = _recent.get(key)
+        expired = entry is not None and time.time() - entry[1].built_at > config.candidate_pools.refresh
+        due = key not in _refreshing and time.time() >= _retry_at.get(key, 0)
+        if (entry is None or entry[0] != pool.built_at or expired) and due:
+            _refreshing.add(key)
+            threading.Thread(target=_refresh, args=(key, pool.built_at), name='candidate-pool-refresh',
+                             daemon=True).start()
+    return entry[1] if entry else None
+
+
+def _refresh(key, pool_built_at):
+    # Starts candidate_pools.overlap seconds before the pool was built to catch rows committed while it ran
+    try:
+        since = datetime.fromtimestamp(pool_built_at) - timedelta(seconds=config.candidate_pools.overlap)
+        live_pool = build(key[0], key[1], since)
+        with _recent_lock:
+            _recent[key] = (pool_built_at, live_pool)
+    except Exception:
+        traceback.print_exc()
+        with _recent_lock:
+            _retry_at[key] = time.time() + config.candidate_pools.refresh
+    finally:
+        db.close()
+        with _recent_lock:
+            _refreshing.discard(key)
+
+
+def find(section, since):
+    # The smallest pool of a section covering everything created after `since`
+    for freq in sorted(WINDOWS, key=WINDOWS.get):
+        pool = get(section, freq)
+        if pool is not None and pool.since <= since.timestamp():
+            return pool
+    return None
+
+
+def stats():
+    with _pools_lock:
+        pools = {'{}_{}'.format(*key): pool.stats() for key, (_, pool) in _pools.items()}
+    with _recent_lock:
+        pools.update({'{}_{}_recent'.format(*key): pool.stats() for key, (_, pool) in _recent.items()})
+    return pools
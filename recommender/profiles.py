@@ -1,26 +1,91 @@
 import itertools
 import operator
-from collections import Counter
+from collections import Counter, defaultdict
 from types import SimpleNamespace
-from recommender import config, models, db, queries
+from recommender import config, models, db, queries, features, storage
 import numpy
 from sklearn.externals import joblib
 from sklearn.feature_extraction.text import TfidfTransformer
 import scipy.sparse as sparse
 from pathlib import Path
 from datetime import datetime, timedelta
-from cachetools import LFUCache, cached
 
 
-@cached(cache=LFUCache(maxsize=100))
 class QuestionProfile:
 
-    def __init__(self, id):
+    def __init__(self, id, content=None, tags=None, topics=None, terms=None):
         self.id = id
+        if content is None:
+            with db.connection() as conn:
+                cur = conn.cursor()
+                cur.execute(queries.user_profile['question_get_content'], (self.id,))
+                content = cur.fetchone()
+        _, self.title, self.body, self.creation_date = content
+        if tags is not None:
+            self.__tags = tags
+        if topics is not None:
+            self.__topics = topics
+        if terms is not None:
+            self.__terms = terms
+
+    @classmethod
+    def load_many(cls, ids):
+        # Hydrate content, tags, topics and stored term vectors of all questions missing from the feature store
+        # in a few set-based queries; profiles are returned in the order of `ids` (duplicates kept), missing questions are skipped
+        ids = [id for id in ids if id is not None]
+        if not ids:
+            return []
+
+        store = features.question_store()
         with db.connection() as conn:
             cur = conn.cursor()
-            cur.execute(queries.user_profile['question_get_content'], (self.id,))
-            _, self.title, self.body, self.creation_date = cur.fetchone()
+            cur.execute(queries.user_profile['questions_get_versions'], (list(set(ids)),))
+            versions = {qid: str(version) for qid, version in cur}
+
+        profiles = store.get_many(versions)
+        missing = [qid for qid in versions if qid not in profiles]
+
+        if missing:
+            tags, topics = defaultdict(list), defaultdict(list)
+            with db.connection() as conn:
+                cur = conn.cursor()
+                cur.execute(queries.user_profile['questions_get_content'], (missing,))
+                contents = cur.fetchall()
+                cur.execute(queries.user_profile['questions_get_tags'], (missing,))
+                for qid, tag in cur:
+                    tags[qid].append(tag)
+                cur.execute(queries.user_profile['questions_get_topics'], (missing,))
+                for qid, topic, weight in cur:
+                    topics[qid].append((topic, weight))
+            terms = features.term_store().get_many({qid: features.text_digest(title, body)
+                                                    for qid, title, body, _ in contents})
+            unvectorized = [content for content in contents if content[0] not in terms]
+            if unvectorized:
+                # Not vectorized by the cron jobs yet or edited since; done before the profiles are stored, so that their size
+                # estimate in the feature store includes the terms
+                vocab_model = models.load(models.MODEL_VOCAB)
+                tf = vocab_model.transform([models.process_question(title, body) for _, title, body, _ in unvectorized])
+                for row, content in enumerate(unvectorized):
+                    terms[content[0]] = tf[row]
+
+            hydrated = {}
+            for content in contents:
+                qid = content[0]
+                profile = cls(qid, content, tags[qid], topics[qid], terms.get(qid))
+                profiles[qid] = hydrated[(qid, versions[qid])] = profile
+            store.put_many(hydrated)
+
+        return [profiles[id] for id in ids if id in profiles]
+
+    def memory_size(self):
+        # Rough estimate of the memory held by the profile, used for the feature store budget
+        size = 200 + len(self.title or '') + len(self.body or '')
+        size += 40 * len(self.__dict__.get('_QuestionProfile__tags', ()))
+        size += 80 * len(self.__dict__.get('_QuestionProfile__topics', ()))
+        terms = self.__dict__.get('_QuestionProfile__terms')
+        if terms is not None:
+            size += terms.data.nbytes + terms.indices.nbytes + terms.indptr.nbytes
+        return size
 
     def tags(self):
         try:
@@ -46,38 +111,122 @@ class QuestionProfile:
         try:
             return self.__terms
         except AttributeError:
-            vocab_model = models.load(models.MODEL_VOCAB)
-            self.__terms = vocab_model.transform([models.process_question(self.title, self.body)])
+            digest = features.text_digest(self.title, self.body)
+            self.__terms = features.term_store().get_many({self.id: digest}).get(self.id)
+            if self.__terms is None:
+                # Not vectorized by the cron jobs yet or edited since
+                vocab_model = models.load(models.MODEL_VOCAB)
+                self.__terms = vocab_model.transform([models.process_question(self.title, self.body)])
             return self.__terms
 
 
 
+def fetch_activity(users):
+    # Question IDs of the activities of a batch of (user ID, since) pairs, one query per activity type;
+    # returns {user ID: {activity: [question IDs]}}
+    params = {'user_ids': [uid for uid, _ in users], 'since': [since for _, since in users]}
+    activity = {uid: defaultdict(list) for uid, _ in users}
+    with db.connection() as conn:
+        cur = conn.cursor()
+        for key in ('asked_qs', 'commented_qs', 'favorited_qs'):
+            cur.execute(queries.user_activity[key], params)
+            for uid, qid in cur:
+                activity[uid][key].append(qid)
+
+        cur.execute(queries.user_activity['answers'], params)
+        for uid, qid, score, is_accepted in cur:
+            if score is not None:
+                activity[uid]['positive_as' if score >= 0 else 'negative_as'].append(qid)
+            if is_accepted:
+                activity[uid]['accepted_as'].append(qid)
+
+        cur.execute(queries.user_activity['feedback'], params)
+        for uid, qid, response_type, value in cur:
+            if response_type == 'click' and value is None:
+                activity[uid]['implicit_fb'].append(qid)
+            elif response_type == 'feedback' and value == 1:
+                activity[uid]['explicit_pos'].append(qid)
+            elif response_type == 'feedback' and value == -1:
+                activity[uid]['explicit_neg'].append(qid)
+    return activity
+
+
+def hydrate_activity(activity):
+    # Replace question IDs with question profiles, hydrating the questions of all users at once
+    question_ids = {qid for lists in activity.values() for qids in lists.values() for qid in qids}
+    questions = {q.id: q for q in QuestionProfile.load_many(question_ids)}
+    return {uid: defaultdict(list, {key: [questions[qid] for qid in qids if qid in questions]
+                                    for key, qids in lists.items()})
+            for uid, lists in activity.items()}
+
+
+
 class UserProfile:
+    load_error = None
+    version = None
+
     def __init__(self, id):
         self.id = id
         self.iterations = 0
         self.since = None
-        self.interests = SimpleNamespace(tags=None, topics=None, terms=None, tfidf=None, total=0)
-        self.expertise = SimpleNamespace(tags=None, topics=None, terms=None, tfidf=None, total=0)
-
-    def save(self, file_path=None):
-        if file_path:
-            return joblib.dump(self, file_path)
-        model_dir = Path('.') / config.models['dir'] / config.models['user-dir']
-        if not model_dir.exists():
-            model_dir.mkdir(parents=True)
-        model_file = model_dir / '{}.pkl'.format(self.id)
-        return joblib.dump(self, model_file)
+        self.interests = SimpleNamespace(tags=None, topics=None, terms=None, weights=None, tfidf=None, total=0)
+        self.expertise = SimpleNamespace(tags=None, topics=None, terms=None, weights=None, tfidf=None, total=0)
+
+    def __getattr__(self, name):
+        # Sections of a profile read from storage are unpacked on first access
+        archive = self.__dict__.get('_archive')
+        if archive is None or name not in storage.LAZY_ATTRIBUTES:
+            raise AttributeError(name)
+        try:
+            value = storage.unpack(archive, name)
+        except Exception as e:
+            # A corrupt section only shows up now; it is served empty and reported like a profile that failed to load
+            self.load_error = 'Unpacking {} failed: {}: {}'.format(name, type(e).__name__, e)
+            value = storage.empty(name)
+        setattr(self, name, value)
+        return value
+
+    def unpack(self):
+        # Unpack all sections; a profile with a corrupt one starts over untrained, like a profile that failed to load
+        for name in storage.LAZY_ATTRIBUTES:
+            getattr(self, name, None)
+        if self.load_error and self.iterations > 0:
+            self.iterations, self.since = 0, None
+            self.interests, self.expertise = storage.empty('interests'), storage.empty('expertise')
+            self.centroids, self.rankings = None, None
+
+    @staticmethod
+    def _model_dir():
+        return Path('.') / config.models['dir'] / config.models['user-dir']
+
+    def save(self):
+        if getattr(self, 'rankings', None) is None:
+            # Store the rankings of a profile loaded from an older format
+            self._update_rankings()
+        storage.profile_store().put(self.id, storage.dumps(self))
+
+    @classmethod
+    def _load(cls, untrained):
+        model_file = cls._model_dir() / '{}.npz'.format(untrained.id)
+        legacy_file = model_file.with_suffix('.pkl')
+        try:
+            version, data = storage.profile_store().get(untrained.id)
+            if data is not None:
+                profile = storage.loads(data, cls)
+                profile.version = version
+                return profile
+            # Not imported into the profile store yet (see migrate-user-profiles.py)
+            elif model_file.exists():
+                return storage.loads(model_file.read_bytes(), cls)
+            elif legacy_file.exists():
+                return joblib.load(legacy_file)
+        except Exception as e:
+            untrained.load_error = '{}: {}'.format(type(e).__name__, e)
+        return untrained
 
     @classmethod
     def load(cls, id):
-        model_file = Path('.') / config.models['dir'] / config.models['user-dir'] / '{}.pkl'.format(id)
-        if model_file.exists():
-            try:
-                return joblib.load(model_file)
-            except:
-                return cls(id)
-        return cls(id)
+        return cls._load(cls(id))
 
     def _get_topics(self):
         try:
@@ -97,22 +246,24 @@ class UserProfile:
         with db.connection() as conn:
             cur = conn.cursor()
             cur.execute(question_query.format(since=since_query), params)
-            return [QuestionProfile(question[0]) for question in cur]
+            question_ids = [question[0] for question in cur]
+        return QuestionProfile.load_many(question_ids)
 
-    def _get_qlists(self, since=None):
-        asked_qs = self._get_question_profiles(queries.user_profile['asked_qs'], since)
-        commented_qs = self._get_question_profiles(queries.user_profile['commented_qs'], since)
-        favorited_qs = self._get_question_profiles(queries.user_profile['favorited_qs'], since, since_table='f.')
+    def _get_qlists(self, since=None, activity=None):
+        if activity is None:
+            activity = hydrate_activity(fetch_activity([(self.id, since)]))[self.id]
 
-        answer_query_base = queries.user_profile['answer_query_base']
-        positive_as = self._get_question_profiles(answer_query_base + ' AND score >= 0', since)
-        negative_as = self._get_question_profiles(answer_query_base + ' AND score < 0', since)
-        accepted_as = self._get_question_profiles(answer_query_base + ' AND is_accepted', since)
+        asked_qs = activity['asked_qs']
+        commented_qs = activity['commented_qs']
+        favorited_qs = activity['favorited_qs']
+
+        positive_as = activity['positive_as']
+        negative_as = activity['negative_as']
+        accepted_as = activity['accepted_as']
 
-        fb_query_base = queries.user_profile['feedback_query_base']
-        implicit_fb = self._get_question_profiles(fb_query_base.format(fb='click', val='IS NULL'), since, since_table='e.')
-        explicit_pos = self._get_question_profiles(fb_query_base.format(fb='feedback', val='= 1'), since, since_table='e.')
-        explicit_neg = self._get_question_profiles(fb_query_base.format(fb='feedback', val='= -1'), since, since_table='e.')
+        implicit_fb = activity['implicit_fb']
+        explicit_pos = activity['explicit_pos']
+        explicit_neg = activity['explicit_neg']
 
         interests = [
             (asked_qs,      1.00),
@@ -137,10 +288,6 @@ class UserProfile:
     def _sum_weighted_qlists(self, qlists):
         return sum(len(qlist) * abs(weight) for qlist, weight in qlists)
 
-    def _sort_wlist(self, args):
-        lst, weight = args
-        return sorted(lst, key=lambda t: t[1], reverse=True), weight
-
     def _merge_wlists(self, old, new, decay_factor=1.0):
         sum_w = old[1] + new[1]
         res = Counter({k: v * old[1] * decay_factor for k, v in old[0]})
@@ -149,10 +296,31 @@ class UserProfile:
         return list(res.items()), sum_w
 
     def _merge_matrices(self, old, new, decay_factor=1.0):
-        if old is not None and new is not None:
-            return sparse.bmat([[old * decay_factor], [new]])
+        (old_terms, old_weights), (new_terms, new_weights) = old, new
+        if old_terms is not None and new_terms is not None:
+            terms = sparse.bmat([[old_terms * decay_factor], [new_terms]], 'csr')
+            weights = numpy.concatenate([old_weights * decay_factor, new_weights])
+            return self._cap_matrix(terms, weights)
         else:
-            return new
+            return new if old_terms is None else old
+
+    def _cap_matrix(self, terms, weights):
+        # Keep only the most heavily weighted (decayed) rows, in their original order. TF-IDF rows are L2
+        # normalized, so dropping rows is the only effect the cap has on scoring.
+        max_rows = config.user_profile.max_term_rows
+        if terms is None or terms.shape[0] <= max_rows:
+            return terms, weights
+        keep = numpy.sort(numpy.argpartition(-numpy.abs(weights), max_rows - 1)[:max_rows])
+        return terms[keep], weights[keep]
+
+    def _get_terms(self, section):
+        weights = getattr(section, 'weights', None)
+        if section.terms is not None and weights is None:
+            # Profile saved before row weights were tracked; rank rows by recency, keeping their sign
+            rows = section.terms.shape[0]
+            signs = numpy.sign(numpy.asarray(section.terms.sum(1)).ravel())
+            weights = signs * numpy.arange(1, rows + 1) / rows
+        return section.terms, weights
 
     def _get_tag_weights(self, weighted_qlists):
         tag_counts = Counter()
@@ -204,16 +372,65 @@ class UserProfile:
         # Flatten Q list
         weighted_questions = [(q, weight) for qlist, weight in weighted_qlists for q in qlist]
         if len(weighted_questions) == 0:
-            return None
+            return None, None
 
-        # Create TF matrix while applying Q weights
-        return sparse.vstack(itertools.starmap(operator.mul, ((q.terms(), w) for q, w in weighted_questions)), 'csr')
+        # Create TF matrix while applying Q weights, keep the weights of its rows
+        tf = sparse.vstack(itertools.starmap(operator.mul, ((q.terms(), w) for q, w in weighted_questions)), 'csr')
+        return tf, numpy.array([w for _, w in weighted_questions], dtype=float)
 
     def _calculate_tfidf(self, tf):
         return TfidfTransformer().fit_transform(tf)
 
-    def train(self):
-        int_qlists, exp_qlists = self._get_qlists()
+    def _update_centroids(self):
+        # Mean TF-IDF vectors of the interests, expertise and combined (stacked) user matrices
+        sums, rows = {}, {}
+        for key in ('interests', 'expertise'):
+            tfidf = getattr(self, key).tfidf
+            if tfidf is not None and tfidf.shape[0] > 0:
+                sums[key], rows[key] = sparse.csr_matrix(tfidf.sum(0)), tfidf.shape[0]
+
+        self.centroids = {key: sums[key] / rows[key] for key in sums}
+        if len(sums) == 2:
+            self.centroids['both'] = (sums['interests'] + sums['expertise']) / (rows['interests'] + rows['expertise'])
+        elif sums:
+            self.centroids['both'] = next(iter(self.centroids.values()))
+
+    def _rank_wlist(self, wlist):
+        # IDs and weights of a weighted list, heaviest first; ties keep their order
+        lst, _ = wlist if wlist is not None else ([], 0)
+        ids = numpy.array([id for id, _ in lst], dtype=numpy.int64)
+        weights = numpy.array([w for _, w in lst], dtype=numpy.float64)
+        order = numpy.argsort(-weights, kind='mergesort')
+        return ids[order], weights[order]
+
+    def _update_rankings(self):
+        # Tags and topics of the interests, expertise and merged sections, sorted once at train time
+        self.rankings = {}
+        for key in ('tags', 'topics'):
+            interests_list, expertise_list = getattr(self.interests, key), getattr(self.expertise, key)
+            if interests_list is not None and expertise_list is not None:
+                both_list = self._merge_wlists(interests_list, expertise_list)
+            else:
+                both_list = interests_list or expertise_list
+            self.rankings[key + '.interests'] = self._rank_wlist(interests_list)
+            self.rankings[key + '.expertise'] = self._rank_wlist(expertise_list)
+            self.rankings[key + '.both'] = self._rank_wlist(both_list)
+
+    def _get_centroid(self, interests, expertise):
+        if getattr(self, 'centroids', None) is None:
+            # Profile trained before centroids were stored
+            self._update_centroids()
+
+        if interests and expertise:
+            return self.centroids.get('both')
+        elif interests:
+            return self.centroids.get('interests')
+        elif expertise:
+            return self.centroids.get('expertise')
+        return None
+
+    def train(self, activity=None):
+        int_qlists, exp_qlists = self._get_qlists(activity=activity)
 
         self.interests.tags = self._get_tag_weights(int_qlists)
         self.expertise.tags = self._get_tag_weights(exp_qlists)
@@ -221,8 +438,8 @@ class UserProfile:
         self.interests.topics = self._get_topic_weights(int_qlists)
         self.expertise.topics = self._get_topic_weights(exp_qlists)
 
-        self.interests.terms = self._get_tf_matrix(int_qlists)
-        self.expertise.terms = self._get_tf_matrix(exp_qlists)
+        self.interests.terms, self.interests.weights = self._cap_matrix(*self._get_tf_matrix(int_qlists))
+        self.expertise.terms, self.expertise.weights = self._cap_matrix(*self._get_tf_matrix(exp_qlists))
 
         self.interests.tfidf = self._calculate_tfidf(self.interests.terms)
         self.expertise.tfidf = self._calculate_tfidf(self.expertise.terms)
@@ -230,17 +447,19 @@ class UserProfile:
         self.interests.total = self._sum_weighted_qlists(int_qlists)
         self.expertise.total = self._sum_weighted_qlists(exp_qlists)
 
+        self._update_centroids()
+        self._update_rankings()
         self.since = datetime.now()
         self.iterations += 1
 
-    def retrain(self, since=None):
-
+    def retrain(self, since=None, activity=None):
+        self.unpack()
         if self.iterations == 0:
-            return self.train()
+            return self.train(activity)
 
         if not since:
             since = self.since
-        int_qlists, exp_qlists = self._get_qlists(since)
+        int_qlists, exp_qlists = self._get_qlists(since, activity)
 
         interests_total = self._sum_weighted_qlists(int_qlists)
         expertise_total = self._sum_weighted_qlists(exp_qlists)
@@ -251,7 +470,8 @@ class UserProfile:
 
             self.interests.tags = self._merge_wlists(self.interests.tags, self._get_tag_weights(int_qlists), int_decay)
             self.interests.topics = self._merge_wlists(self.interests.topics, self._get_topic_weights(int_qlists), int_decay)
-            self.interests.terms = self._merge_matrices(self.interests.terms, self._get_tf_matrix(int_qlists), int_decay)
+            self.interests.terms, self.interests.weights = self._merge_matrices(
+                self._get_terms(self.interests), self._get_tf_matrix(int_qlists), int_decay)
             self.interests.tfidf = self._calculate_tfidf(self.interests.terms)
             self.interests.total += interests_total
 
@@ -261,33 +481,48 @@ class UserProfile:
 
             self.expertise.tags = self._merge_wlists(self.expertise.tags, self._get_tag_weights(exp_qlists), exp_decay)
             self.expertise.topics = self._merge_wlists(self.expertise.topics, self._get_topic_weights(exp_qlists), exp_decay)
-            self.expertise.terms = self._merge_matrices(self.expertise.terms, self._get_tf_matrix(exp_qlists), exp_decay)
+            self.expertise.terms, self.expertise.weights = self._merge_matrices(
+                self._get_terms(self.expertise), self._get_tf_matrix(exp_qlists), exp_decay)
             self.expertise.tfidf = self._calculate_tfidf(self.expertise.terms)
             self.expertise.total += expertise_total
 
+        self._update_centroids()
+        self._update_rankings()
         self.since = datetime.now()
         self.iterations += 1
 
-    def _get_profile_list(self, n, key, interests, expertise, weights):
-        interests_list = getattr(self.interests, key)
-        expertise_list = getattr(self.expertise, key)
+    def compact(self):
+        # Bound the term matrices of a profile saved before they were capped
+        for section in (self.interests, self.expertise):
+            terms, weights = self._cap_matrix(*self._get_terms(section))
+            if terms is not None:
+                section.terms, section.weights = terms, weights
+                section.tfidf = self._calculate_tfidf(terms)
+        self._update_centroids()
+        self._update_rankings()
+
+    def get_ranking(self, key, interests=True, expertise=True):
+        # ('tags' or 'topics') IDs and weights of the profile sections, heaviest first
+        if getattr(self, 'rankings', None) is None:
+            # Profile saved before the rankings were stored
+            self._update_rankings()
 
         if interests and expertise:
-            res = self._merge_wlists(interests_list, expertise_list)
+            return self.rankings[key + '.both']
         elif interests:
-            res = interests_list
+            return self.rankings[key + '.interests']
         elif expertise:
-            res = expertise_list
-        else:
-            return []
+            return self.rankings[key + '.expertise']
+        return numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.float64)
 
-        sorted_list, _ = self._sort_wlist(res)
-        length = len(sorted_list)
+    def _get_profile_list(self, n, key, interests, expertise, weights):
+        ids, ranked_weights = self.get_ranking(key, interests, expertise)
+        length = len(ids)
         max_index = min(length, abs(n)) if n != -1 else length
         if weights:
-            return sorted_list[:max_index]
+            return list(zip(ids[:max_index].tolist(), ranked_weights[:max_index].tolist()))
         else:
-            return [t for t, _ in sorted_list[:max_index]]
+            return ids[:max_index].tolist()
 
     def get_tags(self, n, interests=True, expertise=True, weights=False):
         return self._get_profile_list(n, 'tags', interests, expertise, weights)
@@ -295,26 +530,25 @@ class UserProfile:
     def get_topics(self, n, interests=True, expertise=True, weights=False):
         return self._get_profile_list(n, 'topics', interests, expertise, weights)
 
-    def match_questions(self, qlist, interests=True, expertise=True):
-        q_index = [q.id for q in qlist]
-        q_matrix = self._calculate_tfidf(sparse.vstack((q.terms() for q in qlist), 'csr'))
-
-        if interests and expertise:
-            u_matrix = sparse.bmat([[self.interests.tfidf], [self.expertise.tfidf]])
-        elif interests:
-            u_matrix = self.interests.tfidf
-        elif expertise:
-            u_matrix = self.expertise.tfidf
-        else:
+    def match_questions(self, question_ids, interests=True, expertise=True, n=-1):
+        u_vector = self._get_centroid(interests, expertise)
+        if u_vector is None:
             return []
 
-        # Calc mean values in user matrix along the '0' axis
-        u_vector = u_matrix.mean(0)
+        qlist = QuestionProfile.load_many(question_ids)
+        if not qlist:
+            return []
+        q_index = [q.id for q in qlist]
+        q_matrix = self._calculate_tfidf(sparse.vstack([q.terms() for q in qlist], 'csr'))
 
-        # Calc similarity (dot product) of Qs and user, return list of sorted Q-IDs and weights
-        product = u_vector * q_matrix.T
-        sorted_list = sorted(zip(q_index, product.A[0]), key=lambda t: t[1], reverse=True)
-        return sorted_list
+        # Calc similarity (dot product) of Qs and user centroid, return top `n` (all if -1) Q-IDs and weights
+        scores = (q_matrix * u_vector.T).toarray().ravel()
+        if 0 < n < len(scores):
+            top = numpy.argpartition(-scores, n - 1)[:n]
+        else:
+            top = numpy.arange(len(scores))
+        top = top[numpy.argsort(-scores[top], kind='mergesort')]
+        return [(q_index[i], scores[i]) for i in top]
 
 
 
@@ -324,10 +558,10 @@ class CommunityProfile(UserProfile):
         self.id = 'community'
         self.iterations = 0
         self.since = None
-        self.interests = SimpleNamespace(tags=None, topics=None, terms=None, tfidf=None, total=0)
-        self.expertise = SimpleNamespace(tags=None, topics=None, terms=None, tfidf=None, total=0)
+        self.interests = SimpleNamespace(tags=None, topics=None, terms=None, weights=None, tfidf=None, total=0)
+        self.expertise = SimpleNamespace(tags=None, topics=None, terms=None, weights=None, tfidf=None, total=0)
 
-    def _get_qlists(self, since=None):
+    def _get_qlists(self, since=None, activity=None):
         if since is None:
             since = datetime.now() - timedelta(days=10)
         asked_qs = self._get_question_profiles(queries.user_profile['community_asked_qs'], since)
@@ -347,10 +581,4 @@ class CommunityProfile(UserProfile):
 
     @classmethod
     def load(cls):
-        model_file = Path('.') / config.models['dir'] / config.models['user-dir'] / 'community.pkl'
-        if model_file.exists():
-            try:
-                return joblib.load(model_file)
-            except:
-                return cls()
-        return cls()
+        return cls._load(cls())
@@ -36,17 +36,74 @@ WITH question_ids AS (
         AND n.user_id IN (SELECT id FROM site_users)
     ) united
 )
-SELECT id, title, body FROM questions
-WHERE id IN (SELECT id FROM question_ids)
-AND id NOT IN (SELECT DISTINCT question_id FROM mls_question_topics)
-AND removed IS NULL;
+SELECT q.id, q.title, q.body FROM questions q
+WHERE q.id IN (SELECT id FROM question_ids)
+AND NOT EXISTS (SELECT 1 FROM mls_question_topics t WHERE t.question_id = q.id)
+AND q.removed IS NULL;
 """
 
+# Unprofiled questions of the user activity added between two high-water marks (row IDs) of every source:
+# site ID, then (after, up to) ID pairs of questions, answers, comments (twice), favorites and evaluations (twice)
+user_activity_since = """
+WITH
+    site_users AS (SELECT id FROM users WHERE account_id IS NOT NULL AND site_id = %s),
+    question_ids AS (
+        -- Questions
+        SELECT id FROM questions WHERE id > %s AND id <= %s AND owner_id IN (SELECT id FROM site_users)
+        UNION
+        -- Answers
+        SELECT question_id AS id FROM answers WHERE id > %s AND id <= %s AND owner_id IN (SELECT id FROM site_users)
+        UNION
+        -- Comments on questions
+        SELECT question_id AS id FROM comments
+        WHERE id > %s AND id <= %s AND question_id IS NOT NULL AND owner_id IN (SELECT id FROM site_users)
+        UNION
+        -- Comments on answers
+        SELECT a.question_id AS id FROM comments c JOIN answers a ON a.id = c.answer_id
+        WHERE c.id > %s AND c.id <= %s AND c.question_id IS NULL AND c.owner_id IN (SELECT id FROM site_users)
+        UNION
+        -- Favorited questions
+        SELECT q.id FROM user_favorites f JOIN questions q ON q.external_id = f.external_id
+        WHERE f.id > %s AND f.id <= %s
+        UNION
+        -- Questions with feedback
+        SELECT e.content_detail::int AS id FROM evaluation_newsletters e JOIN newsletters n ON n.id = e.newsletter_id
+        WHERE e.id > %s AND e.id <= %s AND e.content_type = 'question' AND e.user_response_type IN ('click', 'feedback')
+        AND n.user_id IN (SELECT id FROM site_users)
+        UNION
+        -- Answers with feedback
+        SELECT a.question_id AS id FROM evaluation_newsletters e JOIN newsletters n ON n.id = e.newsletter_id
+        JOIN answers a ON a.id = e.content_detail::int
+        WHERE e.id > %s AND e.id <= %s AND e.content_type = 'answer' AND e.user_response_type IN ('click', 'feedback')
+        AND n.user_id IN (SELECT id FROM site_users)
+    )
+SELECT q.id, q.title, q.body FROM questions q
+WHERE q.id IN (SELECT id FROM question_ids)
+AND NOT EXISTS (SELECT 1 FROM mls_question_topics t WHERE t.question_id = q.id)
+AND q.removed IS NULL"""
+
+# Current high-water marks of the activity sources, in the order of train.ACTIVITY_SOURCES
+activity_watermarks = """
+SELECT
+    (SELECT COALESCE(MAX(id), 0) FROM questions),
+    (SELECT COALESCE(MAX(id), 0) FROM answers),
+    (SELECT COALESCE(MAX(id), 0) FROM comments),
+    (SELECT COALESCE(MAX(id), 0) FROM user_favorites),
+    (SELECT COALESCE(MAX(id), 0) FROM evaluation_newsletters)"""
+
 all_questions_since = """
+SELECT q.id, q.title, q.body FROM questions q
+WHERE q.site_id = %s AND q.removed IS NULL
+AND q.created_at >= now() - interval '%s days'
+AND NOT EXISTS (SELECT 1 FROM mls_question_topics t
+                WHERE t.question_id = q.id AND t.created_at >= now() - interval '%s days')"""
+
+all_questions_created_since = """
 SELECT id, title, body FROM questions
 WHERE site_id = %s AND removed IS NULL
-AND created_at >= now() - interval '%s days'
-AND id NOT IN (SELECT DISTINCT question_id FROM mls_question_topics WHERE created_at >= now() - interval '%s days')"""
+AND created_at >= now() - interval '%s days'"""
+
+site_users = 'SELECT id FROM users WHERE account_id IS NOT NULL AND site_id = %s'
 
 daily_subscribers = """
 SELECT u.id FROM users u LEFT JOIN accounts a ON u.account_id = a.id
@@ -56,6 +113,10 @@ weekly_subscribers = """
 SELECT u.id FROM users u LEFT JOIN accounts a ON u.account_id = a.id
 WHERE account_id IS NOT NULL AND site_id = %s AND a.frequency = 'w'"""
 
+subscribers = """
+SELECT u.id FROM users u LEFT JOIN accounts a ON u.account_id = a.id
+WHERE account_id IS NOT NULL AND site_id = %s AND a.frequency IN ('d', 'w')"""
+
 question_answer_index = 'SELECT question_id, id FROM answers WHERE id IN %(answers)s'
 
 
@@ -66,190 +127,235 @@ user_profile = {
         SELECT DISTINCT topic_id, weight FROM mls_question_topics
         WHERE question_id = %s ORDER BY weight DESC""",
 
+    # Version of a question's cached profile: its last update or topic update, plus a hash of its tags, which
+    # can change without touching questions.updated_at
+    'questions_get_versions': """
+        SELECT q.id,
+            COALESCE(GREATEST(q.updated_at, (SELECT MAX(t.updated_at) FROM mls_question_topics t WHERE t.question_id = q.id))::text, '')
+            || ':' || COALESCE((SELECT md5(string_agg(qt.tag_id::text, ',' ORDER BY qt.tag_id))
+                                FROM question_tags qt WHERE qt.question_id = q.id), '')
+        FROM questions q WHERE q.id = ANY(%s)""",
+    'questions_get_content': 'SELECT id, title, body, creation_date FROM questions WHERE id = ANY(%s)',
+    'questions_get_tags': 'SELECT question_id, tag_id FROM question_tags WHERE question_id = ANY(%s)',
+    'questions_get_topics': """
+        SELECT DISTINCT question_id, topic_id, weight FROM mls_question_topics
+        WHERE question_id = ANY(%s) ORDER BY question_id, weight DESC""",
+
     'get_topics': 'SELECT DISTINCT topic_id FROM mls_question_topics WHERE site_id = %s ORDER BY topic_id',
 
-    'asked_qs': """
-        SELECT id FROM questions
-        WHERE removed IS NULL AND owner_id = %(user_id)s {since}""",
+    'community_asked_qs': 'SELECT id FROM questions WHERE removed IS NULL {since}',
+    'community_answer_query_base': 'SELECT question_id FROM answers WHERE removed IS NULL {since}',
+}
 
-    'commented_qs': """
-        SELECT question_id AS id FROM comments
-        WHERE removed IS NULL AND question_id IS NOT NULL
-        AND owner_id = %(user_id)s {since} UNION
-        SELECT question_id AS id FROM answers
-        WHERE removed IS NULL AND id IN (
-            SELECT answer_id AS id FROM comments
-            WHERE removed IS NULL AND question_id IS NULL
-            AND owner_id = %(user_id)s {since})""",
-
-    'favorited_qs': """
-        SELECT q.id FROM user_favorites f
-        LEFT JOIN questions q ON q.external_id = f.external_id
-        WHERE q.removed IS NULL AND f.user_id = %(user_id)s {since} AND q.id IS NOT NULL""",
 
-    'answer_query_base': 'SELECT question_id FROM answers WHERE removed IS NULL AND owner_id = %(user_id)s {since}',
+# Activity of a batch of users, each restricted to its own "since" timestamp (NULL for the whole history)
+_activity_batch = """
+    WITH batch AS (
+        SELECT user_id, COALESCE(since, '-infinity') AS since
+        FROM unnest(%(user_ids)s::int[], %(since)s::timestamp[]) AS b (user_id, since))"""
 
-    'feedback_query_base': """
-        SELECT e.content_detail::int FROM evaluation_newsletters e
-        LEFT JOIN newsletters n ON n.id = e.newsletter_id
-        WHERE n.user_id = %(user_id)s
-        AND e.content_type = 'question'
-        AND e.user_response_type = '{fb}'
-        AND e.user_response_detail::int {val}
-        {{since}}
+user_activity = {
+    'asked_qs': _activity_batch + """
+        SELECT b.user_id, q.id FROM questions q
+        JOIN batch b ON b.user_id = q.owner_id
+        WHERE q.removed IS NULL AND q.created_at > b.since""",
+
+    'commented_qs': _activity_batch + """
+        SELECT b.user_id, c.question_id FROM comments c
+        JOIN batch b ON b.user_id = c.owner_id
+        WHERE c.removed IS NULL AND c.question_id IS NOT NULL AND c.created_at > b.since
         UNION
-        SELECT a.question_id FROM evaluation_newsletters e
-        LEFT JOIN newsletters n ON n.id = e.newsletter_id
-        LEFT JOIN answers a ON a.id = e.content_detail::int
-        WHERE n.user_id = %(user_id)s
-        AND e.content_type = 'answer'
-        AND e.user_response_type = '{fb}'
-        AND e.user_response_detail::int {val}
-        {{since}}""",
+        SELECT b.user_id, a.question_id FROM comments c
+        JOIN batch b ON b.user_id = c.owner_id
+        JOIN answers a ON a.id = c.answer_id
+        WHERE c.removed IS NULL AND c.question_id IS NULL AND a.removed IS NULL AND c.created_at > b.since""",
 
-    'community_asked_qs': 'SELECT id FROM questions WHERE removed IS NULL {since}',
-    'community_answer_query_base': 'SELECT question_id FROM answers WHERE removed IS NULL {since}',
+    'favorited_qs': _activity_batch + """
+        SELECT b.user_id, q.id FROM user_favorites f
+        JOIN batch b ON b.user_id = f.user_id
+        JOIN questions q ON q.external_id = f.external_id
+        WHERE q.removed IS NULL AND f.created_at > b.since""",
+
+    'answers': _activity_batch + """
+        SELECT b.user_id, a.question_id, a.score, a.is_accepted FROM answers a
+        JOIN batch b ON b.user_id = a.owner_id
+        WHERE a.removed IS NULL AND a.created_at > b.since""",
+
+    'feedback': _activity_batch + """
+        SELECT b.user_id, e.content_detail::int, e.user_response_type, e.user_response_detail::int
+        FROM evaluation_newsletters e
+        JOIN newsletters n ON n.id = e.newsletter_id
+        JOIN batch b ON b.user_id = n.user_id
+        WHERE e.content_type = 'question'
+        AND e.user_response_type IN ('click', 'feedback')
+        AND e.created_at > b.since
+        UNION
+        SELECT b.user_id, a.question_id, e.user_response_type, e.user_response_detail::int
+        FROM evaluation_newsletters e
+        JOIN newsletters n ON n.id = e.newsletter_id
+        JOIN batch b ON b.user_id = n.user_id
+        LEFT JOIN answers a ON a.id = e.content_detail::int
+        WHERE e.content_type = 'answer'
+        AND e.user_response_type IN ('click', 'feedback')
+        AND e.created_at > b.since""",
 }
 
 
+# Section queries as (candidate sub-select, ordering) pairs
 sections = {
-    'hot-questions': """
-        SELECT DISTINCT * FROM (
-            SELECT q.id, q.score, q.creation_date
-            FROM questions q
-            {joins}
-            WHERE q.site_id = %(site_id)s
-            AND q.score > 3
-            AND q.closed_date IS NULL
-            AND q.id NOT IN %(dupes)s
-            AND q.removed IS NULL
-            AND q.creation_date > %(since)s
-            {where}
-            ) x
-        ORDER BY score DESC, creation_date DESC
-        LIMIT 500""",
-
-    'useful-questions': """
-        SELECT DISTINCT * FROM (
-            SELECT q.id, q.score, q.creation_date
-            FROM questions q
-            LEFT JOIN answers a ON q.id = a.question_id
-            {joins}
-            WHERE q.site_id = %(site_id)s
-            AND q.score > 3
-            AND q.closed_date IS NULL
-            AND a.question_id IS NOT NULL
-            AND q.id NOT IN %(dupes)s
-            AND q.removed IS NULL
-            AND q.creation_date > %(since)s
-            {where}
-            ) x
-        ORDER BY score DESC, creation_date DESC
-        LIMIT 500""",
-
-    'awaiting-answer': """
-        SELECT DISTINCT * FROM (
-            SELECT q.id, q.score, q.creation_date
-            FROM questions q
-            LEFT JOIN answers a ON q.id = a.question_id
-            {joins}
-            WHERE q.site_id = %(site_id)s
-            AND q.score >= 0
-            AND q.closed_date IS NULL
-            AND a.question_id IS NULL
-            AND q.id NOT IN %(dupes)s
-            AND q.removed IS NULL
-            AND q.creation_date > %(since)s
-            {where}
-            ) x
-        ORDER BY score ASC, creation_date DESC
-        LIMIT 500""",
-
-    'popular-unanswered': """
-        SELECT DISTINCT * FROM (
-            SELECT q.id, q.score, q.creation_date
-            FROM questions q
-            LEFT JOIN answers a ON q.id = a.question_id
-            {joins}
-            WHERE q.site_id = %(site_id)s
-            AND q.score > 1
-            AND q.closed_date IS NULL
-            AND a.question_id IS NULL
-            AND q.id NOT IN %(dupes)s
-            AND q.removed IS NULL
-            AND q.creation_date > %(since)s
-            {where}
-            ) x
-        ORDER BY score DESC, creation_date DESC
-        LIMIT 500""",
-
-    'highly-discussed-qs': """
-        SELECT DISTINCT * FROM (
-            SELECT q.id, q.comment_count, q.creation_date
-            FROM questions q
-            {joins}
-            WHERE q.site_id = %(site_id)s
-            AND q.score >= 0
-            AND q.id NOT IN %(dupes)s
-            AND q.comment_count > 3
-            AND q.removed IS NULL
-            AND q.creation_date > %(since)s
-            {where}
-            ) x
-        ORDER BY comment_count DESC, creation_date DESC
-        LIMIT 500""",
-
-    'highly-discussed-as': """
-        SELECT DISTINCT * FROM (
-            SELECT a.id, a.comment_count, a.creation_date
-            FROM answers a
-            LEFT JOIN questions q ON q.id = a.question_id
-            {joins}
-            WHERE a.site_id = %(site_id)s
-            AND a.score >= 0
-            AND a.id NOT IN %(dupes)s
-            AND a.comment_count > 3
-            AND a.removed IS NULL
-            AND a.creation_date > %(since)s
-            {where}
-            ) x
-        ORDER BY comment_count DESC, creation_date DESC
-        LIMIT 500""",
-
-    'interesting-answers': """
-        SELECT DISTINCT * FROM (
-            SELECT a.id, a.score, a.creation_date
-            FROM answers a
-            LEFT JOIN questions q ON q.id = a.question_id
-            {joins}
-            WHERE a.site_id = %(site_id)s
-            AND a.id NOT IN %(dupes)s
-            AND a.score > 1
-            AND a.removed IS NULL
-            AND a.creation_date > %(since)s
-            {where}
-            ) x
-        ORDER BY score DESC, creation_date DESC
-        LIMIT 500""",
+    'hot-questions': ("""
+        SELECT q.id, q.score, q.creation_date{columns}
+        FROM questions q
+        {joins}
+        WHERE q.site_id = %(site_id)s
+        AND q.score > 3
+        AND q.closed_date IS NULL
+        AND q.id NOT IN %(dupes)s
+        AND q.removed IS NULL
+        AND q.creation_date > %(since)s
+        {where}""",
+        'score DESC, creation_date DESC'),
+
+    'useful-questions': ("""
+        SELECT q.id, q.score, q.creation_date{columns}
+        FROM questions q
+        LEFT JOIN answers a ON q.id = a.question_id
+        {joins}
+        WHERE q.site_id = %(site_id)s
+        AND q.score > 3
+        AND q.closed_date IS NULL
+        AND a.question_id IS NOT NULL
+        AND q.id NOT IN %(dupes)s
+        AND q.removed IS NULL
+        AND q.creation_date > %(since)s
+        {where}""",
+        'score DESC, creation_date DESC'),
+
+    'awaiting-answer': ("""
+        SELECT q.id, q.score, q.creation_date{columns}
+        FROM questions q
+        LEFT JOIN answers a ON q.id = a.question_id
+        {joins}
+        WHERE q.site_id = %(site_id)s
+        AND q.score >= 0
+        AND q.closed_date IS NULL
+        AND a.question_id IS NULL
+        AND q.id NOT IN %(dupes)s
+        AND q.removed IS NULL
+        AND q.creation_date > %(since)s
+        {where}""",
+        'score ASC, creation_date DESC'),
+
+    'popular-unanswered': ("""
+        SELECT q.id, q.score, q.creation_date{columns}
+        FROM questions q
+        LEFT JOIN answers a ON q.id = a.question_id
+        {joins}
+        WHERE q.site_id = %(site_id)s
+        AND q.score > 1
+        AND q.closed_date IS NULL
+        AND a.question_id IS NULL
+        AND q.id NOT IN %(dupes)s
+        AND q.removed IS NULL
+        AND q.creation_date > %(since)s
+        {where}""",
+        'score DESC, creation_date DESC'),
+
+    'highly-discussed-qs': ("""
+        SELECT q.id, q.comment_count, q.creation_date{columns}
+        FROM questions q
+        {joins}
+        WHERE q.site_id = %(site_id)s
+        AND q.score >= 0
+        AND q.id NOT IN %(dupes)s
+        AND q.comment_count > 3
+        AND q.removed IS NULL
+        AND q.creation_date > %(since)s
+        {where}""",
+        'comment_count DESC, creation_date DESC'),
+
+    'highly-discussed-as': ("""
+        SELECT a.id, a.comment_count, a.creation_date{columns}
+        FROM answers a
+        LEFT JOIN questions q ON q.id = a.question_id
+        {joins}
+        WHERE a.site_id = %(site_id)s
+        AND a.score >= 0
+        AND a.id NOT IN %(dupes)s
+        AND a.comment_count > 3
+        AND a.removed IS NULL
+        AND a.creation_date > %(since)s
+        {where}""",
+        'comment_count DESC, creation_date DESC'),
+
+    'interesting-answers': ("""
+        SELECT a.id, a.score, a.creation_date{columns}
+        FROM answers a
+        LEFT JOIN questions q ON q.id = a.question_id
+        {joins}
+        WHERE a.site_id = %(site_id)s
+        AND a.id NOT IN %(dupes)s
+        AND a.score > 1
+        AND a.removed IS NULL
+        AND a.creation_date > %(since)s
+        {where}""",
+        'score DESC, creation_date DESC'),
 }
 
 
+# Semi-joins instead of joining the tags and topics, which multiplies the rows and is hard to plan with an OR
+_has_tags = 'EXISTS (SELECT 1 FROM question_tags qt WHERE qt.question_id = q.id AND qt.tag_id {})'
+_has_topics = 'EXISTS (SELECT 1 FROM mls_question_topics qto WHERE qto.question_id = q.id AND qto.topic_id {})'
+
+
 def build_section(section, mode='both'):
     if section not in sections:
         raise AttributeError('No such section')
-    query_base = sections[section]
-    joins, where = '', ''
-
-    if mode == 'tags' or mode == 'both':
-        joins += ' LEFT JOIN question_tags qt ON qt.question_id = q.id'
-    if mode == 'topics' or mode == 'both':
-        joins += ' LEFT JOIN mls_question_topics qto ON qto.question_id = q.id'
+    query_base, order = sections[section]
 
     if mode == 'tags':
-        where = ' AND qt.tag_id = %(tags)s'
+        where = ' AND ' + _has_tags.format('= %(tags)s')
     elif mode == 'topics':
-        where = ' AND qto.topic_id = %(topics)s'
+        where = ' AND ' + _has_topics.format('= %(topics)s')
     elif mode == 'both':
-        where = ' AND (qt.tag_id IN %(tags)s OR qto.topic_id IN %(topics)s)'
+        where = ' AND ({} OR {})'.format(_has_tags.format('= ANY(%(tags)s)'), _has_topics.format('= ANY(%(topics)s)'))
+    else:
+        where = ''
+
+    query = query_base.format(columns='', joins='', where=where)
+    return 'SELECT DISTINCT * FROM ({}) x ORDER BY {} LIMIT 500'.format(query, order)
+
+
+def build_buckets(section):
+    # Candidates of several tag/topic buckets in one query, the first 500 of every bucket in section order:
+    # (id, bucket type, bucket ID) rows for the buckets given as %(bucket_types)s and %(bucket_ids)s arrays
+    if section not in sections:
+        raise AttributeError('No such section')
+    query_base, order = sections[section]
+    joins = """JOIN unnest(%(bucket_types)s::text[], %(bucket_ids)s::int[]) AS b (bucket_type, bucket_id)
+        ON (b.bucket_type = 'tags' AND {}) OR (b.bucket_type = 'topics' AND {})""".format(
+        _has_tags.format('= b.bucket_id'), _has_topics.format('= b.bucket_id'))
+    query = query_base.format(columns=', b.bucket_type, b.bucket_id', joins=joins, where='')
+    return """
+        SELECT id, bucket_type, bucket_id FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY bucket_type, bucket_id ORDER BY {order}) AS bucket_rank
+            FROM (SELECT DISTINCT * FROM ({query}) x) candidates
+        ) ranked
+        WHERE bucket_rank <= 500
+        ORDER BY bucket_type, bucket_id, bucket_rank""".format(query=query, order=order)
+
+
+def order_signs(section):
+    # 1 for every ascending and -1 for every descending column of the section order, to sort (key, created) rows
+    # the way the section does in Python
+    _, order = sections[section]
+    return tuple(-1 if column.split()[-1].upper() == 'DESC' else 1 for column in order.split(','))
 
-    return query_base.format(joins=joins, where=where)
+
+def build_pool(section):
+    # All candidates of a section in section order, regardless of tags and topics: (id, sort key, created, question ID)
+    if section not in sections:
+        raise AttributeError('No such section')
+    query_base, order = sections[section]
+    query = query_base.format(columns=', q.id AS question_id', joins='', where='')
+    return 'SELECT DISTINCT * FROM ({}) x ORDER BY {}'.format(query, order)
@@ -0,0 +1,114 @@
+import time
+import traceback
+from functools import partial
+from multiprocessing import Pool
+
+from recommender import config, db, utils, profiles, storage
+
+
+def _init_worker():
+    # Connections inherited from the parent process must not be used by the forked workers
+    db.reset()
+
+
+def _fetch_chunk_activity(users):
+    # Activity of the whole chunk in one pass; untrained users get their whole history
+    batch = [(user.id, user.since if user.iterations > 0 else None) for user in users]
+    return profiles.hydrate_activity(profiles.fetch_activity(batch))
+
+
+def _failure(uid, e):
+    return uid, '{}: {}'.format(type(e).__name__, e), traceback.format_exc()
+
+
+def _write_chunk(users, write, store, failures):
+    # Writes of the whole chunk are committed to the store at once. If the commit fails, every user is written
+    # on its own so that only the users that really fail are lost; returns the users written.
+    written = []
+    try:
+        with store.batch():
+            for user in users:
+                try:
+                    write(user)
+                    written.append(user)
+                except Exception as e:
+                    failures.append(_failure(user.id, e))
+        return written
+    except Exception:
+        traceback.print_exc()
+
+    retried, written = written, []
+    for user in retried:
+        try:
+            write(user)
+            written.append(user)
+        except Exception as e:
+            failures.append(_failure(user.id, e))
+    return written
+
+
+def _retrain_chunk(user_ids, archive=True):
+    failures = []
+    users = [profiles.UserProfile.load(uid) for uid in user_ids]
+    for user in users:
+        # Before the activity is fetched: a corrupt profile is retrained from the whole history
+        user.unpack()
+    try:
+        activity = _fetch_chunk_activity(users)
+    except Exception:
+        # Fall back to fetching the activity of every user on its own, isolating the failure
+        traceback.print_exc()
+        db.close()
+        activity = {}
+
+    retrained = []
+    for user in users:
+        try:
+            user.retrain(activity=activity.get(user.id))
+            retrained.append(user)
+        except Exception as e:
+            failures.append(_failure(user.id, e))
+            # Continue with a fresh connection in case the failure broke the current one
+            db.close()
+
+    # The profile store is committed before the archive, so an archived snapshot always has a saved profile
+    done = _write_chunk(retrained, lambda user: user.save(), storage.profile_store(), failures)
+    if archive:
+        done = _write_chunk(done, utils.archive_user_profile, storage.profile_archive(), failures)
+    return len(done), failures
+
+
+def _chunks(lst, size):
+    for i in range(0, len(lst), size):
+        yield lst[i:i + size]
+
+
+# Retrain, save and (optionally) archive user profiles in a pool of worker processes, each with its own DB
+# connection. A failing user is logged and skipped; returns the number of retrained profiles and
+# (user ID, error) pairs of the failures.
+def retrain_users(user_ids, logger, workers=None, chunk_size=None, archive=True):
+    retrain_chunk = partial(_retrain_chunk, archive=archive)
+    workers = workers or config.retraining.workers
+    chunk_size = chunk_size or config.retraining.chunk_size
+    user_ids = list(user_ids)
+    start = time.time()
+    done, failures = 0, []
+
+    if workers <= 1:
+        results = map(retrain_chunk, _chunks(user_ids, chunk_size))
+        for chunk_done, chunk_failures in results:
+            done += chunk_done
+            failures += chunk_failures
+    else:
+        with Pool(workers, initializer=_init_worker) as pool:
+            for chunk_done, chunk_failures in pool.imap_unordered(retrain_chunk, _chunks(user_ids, chunk_size)):
+                done += chunk_done
+                failures += chunk_failures
+                logger.debug('Retrained %d/%d user profiles', done + len(failures), len(user_ids))
+
+    for uid, error, trace in failures:
+        logger.error('Retraining user %s failed: %s', uid, error)
+        logger.debug(trace)
+    logger.info('Retrained %d user profiles in %.1fs using %d worker(s), %d failed%s', done, time.time() - start,
+                workers, len(failures), ': ' + ', '.join(str(uid) for uid, _, _ in failures) if failures else '')
+    return done, [(uid, error) for uid, error, _ in failures]
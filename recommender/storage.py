@@ -0,0 +1,352 @@
+import io
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+import numpy
+import scipy.sparse as sparse
+from datetime import datetime
+from types import SimpleNamespace
+
+from recommender import config
+
+# Schema-versioned user profile format: an npz archive with a JSON header and packed arrays for every
+# section, unpacked lazily on first access
+FORMAT_VERSION = 2
+# Format 1 profiles have no stored tag/topic rankings, they are computed when first needed
+SUPPORTED_FORMATS = (1, 2)
+SECTIONS = ('interests', 'expertise')
+LAZY_ATTRIBUTES = SECTIONS + ('centroids', 'rankings')
+CENTROIDS = ('interests', 'expertise', 'both')
+RANKINGS = tuple('{}.{}'.format(key, mode) for key in ('tags', 'topics') for mode in CENTROIDS)
+
+
+class ProfileFormatError(Exception):
+    pass
+
+
+def _pack_list(arrays, key, value):
+    if value is None:
+        return
+    lst, total = value
+    arrays[key + '.ids'] = numpy.array([id for id, _ in lst], dtype=numpy.int64)
+    arrays[key + '.weights'] = numpy.array([w for _, w in lst], dtype=numpy.float64)
+    arrays[key + '.total'] = numpy.float64(total)
+
+
+def _unpack_list(archive, key):
+    if key + '.ids' not in archive.files:
+        return None
+    lst = list(zip(archive[key + '.ids'].tolist(), archive[key + '.weights'].tolist()))
+    return lst, float(archive[key + '.total'])
+
+
+def _pack_matrix(arrays, key, matrix):
+    if matrix is None:
+        return
+    matrix = sparse.csr_matrix(matrix)
+    arrays[key + '.data'] = matrix.data
+    arrays[key + '.indices'] = matrix.indices
+    arrays[key + '.indptr'] = matrix.indptr
+    arrays[key + '.shape'] = numpy.array(matrix.shape, dtype=numpy.int64)
+
+
+def _unpack_matrix(archive, key):
+    if key + '.data' not in archive.files:
+        return None
+    return sparse.csr_matrix((archive[key + '.data'], archive[key + '.indices'], archive[key + '.indptr']),
+                             shape=tuple(archive[key + '.shape']))
+
+
+def pack(profile):
+    header = {
+        'format': FORMAT_VERSION,
+        'id': profile.id,
+        'iterations': profile.iterations,
+        'since': profile.since.isoformat() if profile.since else None,
+    }
+    arrays = {'header': numpy.frombuffer(json.dumps(header).encode('utf-8'), dtype=numpy.uint8)}
+
+    for name in SECTIONS:
+        section = getattr(profile, name)
+        arrays[name + '.total'] = numpy.float64(section.total)
+        _pack_list(arrays, name + '.tags', section.tags)
+        _pack_list(arrays, name + '.topics', section.topics)
+        _pack_matrix(arrays, name + '.terms', section.terms)
+        _pack_matrix(arrays, name + '.tfidf', section.tfidf)
+        if getattr(section, 'weights', None) is not None:
+            arrays[name + '.weights'] = section.weights
+
+    for name, centroid in (getattr(profile, 'centroids', None) or {}).items():
+        _pack_matrix(arrays, 'centroid.' + name, centroid)
+
+    for name, (ids, weights) in (getattr(profile, 'rankings', None) or {}).items():
+        arrays['ranking.' + name + '.ids'] = ids
+        arrays['ranking.' + name + '.weights'] = weights
+    return arrays
+
+
+def empty(name):
+    # Value of a lazy attribute that could not be unpacked
+    if name in SECTIONS:
+        return SimpleNamespace(tags=None, topics=None, terms=None, weights=None, tfidf=None, total=0)
+    return None
+
+
+_unpack_lock = threading.Lock()
+def unpack(archive, name):
+    # Cached profiles are shared between threads, and reading from the same archive is not thread-safe
+    with _unpack_lock:
+        return _unpack(archive, name)
+
+
+def _unpack(archive, name):
+    if name == 'centroids':
+        centroids = {key: _unpack_matrix(archive, 'centroid.' + key) for key in CENTROIDS}
+        return {key: centroid for key, centroid in centroids.items() if centroid is not None} or None
+    if name == 'rankings':
+        if any('ranking.' + key + '.ids' not in archive.files for key in RANKINGS):
+            return None
+        return {key: (archive['ranking.' + key + '.ids'], archive['ranking.' + key + '.weights']) for key in RANKINGS}
+
+    section = empty(name)
+    section.total = float(archive[name + '.total'])
+    section.tags = _unpack_list(archive, name + '.tags')
+    section.topics = _unpack_list(archive, name + '.topics')
+    section.terms = _unpack_matrix(archive, name + '.terms')
+    section.tfidf = _unpack_matrix(archive, name + '.tfidf')
+    if name + '.weights' in archive.files:
+        section.weights = archive[name + '.weights']
+    return section
+
+
+def _parse_datetime(value):
+    # isoformat() leaves out the microseconds when they are zero
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def dumps(profile, arrays=None):
+    buffer = io.BytesIO()
+    numpy.savez_compressed(buffer, **(arrays or pack(profile)))
+    return buffer.getvalue()
+
+
+def digest(arrays):
+    # Hash of packed arrays; the header (iteration, since) is left out
+    h = hashlib.sha1()
+    for key in sorted(arrays):
+        if key != 'header':
+            h.update(key.encode('utf-8'))
+            h.update(numpy.ascontiguousarray(arrays[key]).tobytes())
+    return h.hexdigest()
+
+
+def loads(data, cls):
+    # Read the header eagerly and leave the sections to be unpacked when they are first accessed
+    archive = numpy.load(io.BytesIO(data))
+    if 'header' not in archive.files:
+        raise ProfileFormatError('Missing profile header')
+    header = json.loads(archive['header'].tobytes().decode('utf-8'))
+    if header.get('format') not in SUPPORTED_FORMATS:
+        raise ProfileFormatError('Unsupported profile format version: {}'.format(header.get('format')))
+
+    profile = cls.__new__(cls)
+    profile.id = header['id']
+    profile.iterations = header['iterations']
+    profile.since = _parse_datetime(header['since']) if header['since'] else None
+    profile._archive = archive
+    return profile
+
+
+# Connections inherited over a fork stay referenced: closing them in the child is unsafe and can release the
+# child's own locks on the file
+_inherited = []
+
+
+# A sqlite file shared by all processes running from the same directory; `schema` statements run on every
+# new connection
+class SqliteStore:
+    schema = ()
+
+    def __init__(self, file):
+        self.file = file
+        self._lock = threading.RLock()
+        self._conn = None
+        self._conn_pid = None
+        self._pending = None
+
+    def _connection(self):
+        # Connections must not cross a fork, so every process opens its own
+        if self._conn is None or self._conn_pid != os.getpid():
+            if self._conn is not None:
+                _inherited.append(self._conn)
+            path = Path(self.file)
+            if not path.parent.exists():
+                path.parent.mkdir(parents=True)
+            self._conn = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                self._conn.execute(statement)
+            self._conn_pid = os.getpid()
+            self._pending = None
+        return self._conn
+
+    def _write(self, statement, rows):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((statement, rows))
+            else:
+                conn = self._connection()
+                with conn:
+                    conn.executemany(statement, rows)
+
+    @contextmanager
+    def batch(self):
+        # Collect writes and commit them in one short transaction when the block exits without an error; if the
+        # commit fails, none of the writes are kept
+        with self._lock:
+            self._connection()
+            self._pending = []
+        try:
+            yield self
+            with self._lock:
+                pending, self._pending = self._pending, None
+                conn = self._connection()
+                with conn:
+                    for statement, rows in pending:
+                        conn.executemany(statement, rows)
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def compact(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.execute('VACUUM')
+
+
+# All current user profiles in a single sqlite file, keyed by profile ID; every write bumps the version.
+# It also holds the claims of the profiles being trained, shared by all processes.
+class ProfileStore(SqliteStore):
+    schema = (
+        'CREATE TABLE IF NOT EXISTS profiles (id TEXT PRIMARY KEY, version INTEGER NOT NULL, '
+        'updated_at TEXT NOT NULL, data BLOB NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS training (id TEXT PRIMARY KEY, claimed_at REAL NOT NULL)',
+    )
+
+    def get(self, id):
+        with self._lock:
+            row = self._connection().execute('SELECT version, data FROM profiles WHERE id = ?', (str(id),)).fetchone()
+        return row if row else (None, None)
+
+    def version(self, id):
+        with self._lock:
+            row = self._connection().execute('SELECT version FROM profiles WHERE id = ?', (str(id),)).fetchone()
+        return row[0] if row else None
+
+    def ids(self):
+        with self._lock:
+            return [row[0] for row in self._connection().execute('SELECT id FROM profiles')]
+
+    def claim_training(self, id, timeout):
+        # True if the caller may train the profile; claims older than `timeout` seconds are left over from
+        # a process that died and are taken over. Claims are committed at once, also within a batch.
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('DELETE FROM training WHERE id = ? AND claimed_at < ?', (str(id), now - timeout))
+                return conn.execute('INSERT OR IGNORE INTO training (id, claimed_at) VALUES (?, ?)',
+                                    (str(id), now)).rowcount == 1
+
+    def release_training(self, id):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('DELETE FROM training WHERE id = ?', (str(id),))
+
+    def put(self, id, data):
+        self._write('INSERT OR REPLACE INTO profiles (id, version, updated_at, data) '
+                    'VALUES (?, COALESCE((SELECT version FROM profiles WHERE id = ?), 0) + 1, ?, ?)',
+                    [(str(id), str(id), datetime.now().isoformat(), data)])
+
+
+# Packed arrays of a profile by the lazy attribute they belong to
+_PARTS = {'interests': 'interests', 'expertise': 'expertise', 'centroid': 'centroids', 'ranking': 'rankings'}
+
+
+def _split(arrays):
+    parts = {}
+    for key, value in arrays.items():
+        if key != 'header':
+            parts.setdefault(_PARTS[key.split('.', 1)[0]], {})[key] = value
+    return parts
+
+
+# Daily profile snapshots stored as deltas: every day keeps the header and a digest per section (interests,
+# expertise, centroids, rankings), while the data of a section is stored only once for each distinct digest.
+# A snapshot is put back together from the sections its digests point to, written on that day or before.
+class ProfileArchive(SqliteStore):
+    schema = (
+        'CREATE TABLE IF NOT EXISTS snapshot_days (id TEXT NOT NULL, day TEXT NOT NULL, header TEXT NOT NULL, '
+        'digests TEXT NOT NULL, PRIMARY KEY (id, day))',
+        'CREATE TABLE IF NOT EXISTS snapshot_sections (id TEXT NOT NULL, part TEXT NOT NULL, digest TEXT NOT NULL, '
+        'day TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (id, part, digest))',
+    )
+
+    def put(self, profile, day):
+        arrays = pack(profile)
+        header = arrays['header'].tobytes().decode('utf-8')
+        parts = _split(arrays)
+        digests = {part: digest(part_arrays) for part, part_arrays in parts.items()}
+        with self._lock:
+            conn = self._connection()
+            stored = set(conn.execute('SELECT part, digest FROM snapshot_sections WHERE id = ?', (str(profile.id),)))
+            # Only the sections that changed since they were last archived are written
+            self._write('INSERT OR IGNORE INTO snapshot_sections (id, part, digest, day, data) VALUES (?, ?, ?, ?, ?)',
+                        [(str(profile.id), part, digests[part], day, dumps(None, parts[part]))
+                         for part in parts if (part, digests[part]) not in stored])
+            self._write('INSERT OR REPLACE INTO snapshot_days (id, day, header, digests) VALUES (?, ?, ?, ?)',
+                        [(str(profile.id), day, header, json.dumps(digests))])
+
+    def get(self, id, day, cls):
+        # Profile as archived on the given day (or the closest day before it)
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute('SELECT header, digests FROM snapshot_days WHERE id = ? AND day <= ? '
+                               'ORDER BY day DESC LIMIT 1', (str(id), day)).fetchone()
+            if not row:
+                return None
+            arrays = {'header': numpy.frombuffer(row[0].encode('utf-8'), dtype=numpy.uint8)}
+            for part, part_digest in json.loads(row[1]).items():
+                data = conn.execute('SELECT data FROM snapshot_sections WHERE id = ? AND part = ? AND digest = ?',
+                                    (str(id), part, part_digest)).fetchone()
+                if not data:
+                    raise ProfileFormatError('Missing {} section of the {} snapshot of {}'.format(part, day, id))
+                with numpy.load(io.BytesIO(data[0])) as part_arrays:
+                    arrays.update({key: part_arrays[key] for key in part_arrays.files})
+
+        buffer = io.BytesIO()
+        numpy.savez(buffer, **arrays)
+        return loads(buffer.getvalue(), cls)
+
+
+_profile_store = None
+def profile_store():
+    global _profile_store
+    if _profile_store is None:
+        _profile_store = ProfileStore(Path('.') / config.models['dir'] / config.models['profile-store'])
+    return _profile_store
+
+
+_profile_archive = None
+def profile_archive():
+    global _profile_archive
+    if _profile_archive is None:
+        _profile_archive = ProfileArchive(Path('.') / config.archive_dir / 'profiles.sqlite')
+    return _profile_archive
@@ -1,32 +1,209 @@
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.decomposition import LatentDirichletAllocation
+import time
+import json
+import bisect
+import hashlib
+import traceback
 import numpy
+from pathlib import Path
+from multiprocessing import Pool
 from psycopg2.extras import execute_values
 
-from recommender import models, config, db
+from recommender import models, config, db, features, queries
 
 model_lda = models.load(models.MODEL_LDA) # type: LatentDirichletAllocation
 model_vocab = models.load(models.MODEL_VOCAB) # type: CountVectorizer
 
-def get_question_topics(question):
-    _, title, body = question
+def get_questions_tf(questions):
+    return model_vocab.transform([models.process_question(title, body) for _, title, body in questions])
 
-    # Calculate LDA topics distribution
-    question_tf = model_vocab.transform([models.process_question(title, body)])
-    question_topics = model_lda.transform(question_tf)[0]
 
-    # Remove topics below threshold (25th percentile)
-    threshold = numpy.percentile(question_topics, config.question_profile.lda_threshold_percentile)
-    topics = list((weight, topic) for topic, weight in enumerate(question_topics) if weight > threshold)
+def get_questions_topics(questions_tf):
+    # Calculate LDA topics distributions of all questions as one matrix
+    questions_topics = model_lda.transform(questions_tf)
+
+    # Remove topics below threshold (25th percentile) of each question
+    thresholds = numpy.percentile(questions_topics, config.question_profile.lda_threshold_percentile, axis=1)
+    mask = questions_topics > thresholds[:, numpy.newaxis]
+    weights = numpy.where(mask, questions_topics, 0)
 
     # Normalize weights
-    total_weight = sum(weight for weight, _ in topics)
-    return [(weight/total_weight, topic) for weight, topic in topics]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        weights /= weights.sum(axis=1, keepdims=True)
+
+    # Returns (question row, topic, weight) triples
+    rows, topics = numpy.nonzero(mask)
+    return zip(rows.tolist(), topics.tolist(), weights[rows, topics].tolist())
 
 
-def persist_question_topics(question, topics):
-    qid = question[0]
+def persist_questions_topics(question_ids, topics):
+    rows = [(question_ids[row], topic, config.site_id, weight) for row, topic, weight in topics]
     with db.connection() as conn:
         execute_values(conn.cursor(), 'INSERT INTO mls_question_topics (question_id, topic_id, site_id, weight, created_at, updated_at) VALUES %s',
-                       ((qid, topic, config.site_id, weight) for weight, topic in topics),
-                       '(%s, %s, %s, %s, NOW(), NOW())')
+                       rows, '(%s, %s, %s, %s, NOW(), NOW())', page_size=1000)
+
+
+def persist_questions_terms(questions, questions_tf):
+    keys = [(qid, features.text_digest(title, body)) for qid, title, body in questions]
+    features.term_store().put_many(keys, questions_tf)
+
+
+def create_questions_profiles(questions):
+    question_ids = [question[0] for question in questions]
+    questions_tf = get_questions_tf(questions)
+    persist_questions_topics(question_ids, get_questions_topics(questions_tf))
+    persist_questions_terms(questions, questions_tf)
+
+
+def stream_questions(query, args, after=None):
+    # Yield chunks of (id, title, body) rows in ID order, starting after question ID `after`. The rows come from a
+    # server-side cursor on a connection of its own, so only one chunk is held in memory and the writes made
+    # while the chunks are persisted (on the connection of the thread) can be committed chunk by chunk.
+    chunk_size = config.question_profile.chunk_size
+    query = 'SELECT * FROM ({}) questions WHERE id > %s ORDER BY id'.format(query.strip().rstrip(';'))
+    conn = db.connect()
+    try:
+        with conn.cursor(name='question_stream') as cur:
+            cur.itersize = chunk_size
+            cur.execute(query, tuple(args) + (after or 0,))
+            while True:
+                questions = cur.fetchmany(chunk_size)
+                if not questions:
+                    break
+                yield questions
+    finally:
+        conn.close()
+
+
+def _checkpoint_key(query, args):
+    # A checkpoint is only resumed by a run of the same query with the same arguments
+    return hashlib.sha1('{}{!r}'.format(query, tuple(args)).encode('utf-8')).hexdigest()
+
+
+def _read_checkpoint(path, key):
+    try:
+        state = json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
+    return state.get('position') if state.get('key') == key else None
+
+
+def _write_checkpoint(path, key, position):
+    # `position` is the last persisted question ID of a stream or the completed ID ranges of a backfill
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_text(json.dumps({'key': key, 'position': position}))
+    tmp_path.replace(path)
+
+
+def create_question_profiles(query, args, progress=None, checkpoint=None):
+    # With a `checkpoint` file, the ID of the last persisted question is recorded after every chunk and an
+    # interrupted run continues after it; the file is removed when the run completes
+    key = _checkpoint_key(query, args)
+    after = _read_checkpoint(checkpoint, key) if checkpoint else None
+    count = 0
+    for questions in stream_questions(query, args, after):
+        create_questions_profiles(questions)
+        count += len(questions)
+        if checkpoint:
+            _write_checkpoint(checkpoint, key, questions[-1][0])
+        if progress:
+            progress(count)
+    if checkpoint and Path(checkpoint).exists():
+        Path(checkpoint).unlink()
+    return count
+
+
+ACTIVITY_SOURCES = ('questions', 'answers', 'comments', 'favorites', 'evaluations')
+
+def create_activity_question_profiles(watermarks_file=None, progress=None):
+    # Profile the questions of the user activity added since the last run. The largest row ID seen of every
+    # activity source is kept in `watermarks_file`; without it, the whole history is scanned. The last
+    # question_profile.watermark_lag IDs below every mark are scanned again for rows committed late; activity
+    # that only counts later (new site users, questions imported after the activity) is caught up weekly by
+    # create_question_profiles(queries.all_user_activity, ...) in cron-weekly.py.
+    watermarks_file = Path(watermarks_file or Path('.') / config.models['dir'] / config.question_profile.watermarks_file)
+    try:
+        marks = json.loads(watermarks_file.read_text())
+    except (OSError, ValueError):
+        marks = {}
+
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(queries.activity_watermarks)
+        new_marks = dict(zip(ACTIVITY_SOURCES, cur.fetchone()))
+
+    lag = config.question_profile.watermark_lag
+    bounds = {source: (max(marks.get(source, 0) - lag, 0), new_marks[source]) for source in ACTIVITY_SOURCES}
+    args = ((config.site_id,) + bounds['questions'] + bounds['answers'] + bounds['comments'] * 2 +
+            bounds['favorites'] + bounds['evaluations'] * 2)
+    count = create_question_profiles(queries.user_activity_since, args, progress)
+
+    # Advance the marks only once all questions are persisted, a failed run is repeated from the old ones
+    tmp_path = watermarks_file.with_name(watermarks_file.name + '.tmp')
+    tmp_path.write_text(json.dumps(new_marks))
+    tmp_path.replace(watermarks_file)
+    return count
+
+
+def _init_backfill_worker():
+    # Models are loaded before the fork and shared copy-on-write; only the DB connection must not be shared
+    db.reset()
+
+
+def _profile_id_range(task):
+    # Returns the range, the number of profiled questions and the error if the range failed; a range that fails
+    # halfway leaves its committed chunks behind, they are not profiled again by queries that skip profiled questions
+    query, args, first_id, last_id = task
+    try:
+        count = create_question_profiles('SELECT * FROM ({}) questions WHERE id BETWEEN %s AND %s'.format(query),
+                                         tuple(args) + (first_id, last_id))
+        return first_id, last_id, count, None
+    except Exception as e:
+        traceback.print_exc()
+        # Continue with a fresh connection in case the failure broke the current one
+        db.close()
+        return first_id, last_id, 0, '{}: {}'.format(type(e).__name__, e)
+
+
+def backfill_question_profiles(query, args, workers, progress=None, checkpoint=None):
+    # Profile the questions selected by `query` in a pool of worker processes pulling ranges of question IDs;
+    # `progress` is called with the number of profiled questions and the overall throughput (questions/s).
+    # A failing range is skipped; returns the number of profiled questions and the (first ID, last ID, error)
+    # of the failed ranges. With a `checkpoint` file, completed ranges are recorded and skipped by a rerun of
+    # the same query and arguments; the file is removed when no range failed.
+    query = query.strip().rstrip(';')
+    key = _checkpoint_key(query, args)
+    completed = sorted(tuple(r) for r in _read_checkpoint(checkpoint, key) or []) if checkpoint else []
+    starts = [first for first, _ in completed]
+
+    def is_completed(id):
+        i = bisect.bisect_right(starts, id) - 1
+        return i >= 0 and id <= completed[i][1]
+
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT id FROM ({}) questions ORDER BY id'.format(query), args)
+        ids = [row[0] for row in cur if not is_completed(row[0])]
+    db.close()
+
+    chunk_size = config.question_profile.chunk_size
+    tasks = [(query, args, ids[i], ids[min(i + chunk_size, len(ids)) - 1]) for i in range(0, len(ids), chunk_size)]
+
+    start, count, failures = time.time(), 0, []
+    with Pool(workers, initializer=_init_backfill_worker) as pool:
+        for first_id, last_id, range_count, error in pool.imap_unordered(_profile_id_range, tasks):
+            if error:
+                failures.append((first_id, last_id, error))
+            else:
+                count += range_count
+                completed.append((first_id, last_id))
+                if checkpoint:
+                    _write_checkpoint(checkpoint, key, completed)
+            if progress:
+                progress(count, count / (time.time() - start))
+
+    if checkpoint and not failures and Path(checkpoint).exists():
+        Path(checkpoint).unlink()
+    return count, failures
@@ -1,8 +1,10 @@
 import random
+import resource
 from pathlib import Path
+from cachetools import LRUCache
 import logging
 from logging.handlers import RotatingFileHandler
-from recommender import config
+from recommender import storage
 from datetime import datetime
 
 def setup_logging(log_file, logger=None):
@@ -25,21 +27,83 @@ def setup_logging(log_file, logger=None):
 
 
 def archive_user_profile(user, at_time=None):
-    archive_dir = Path('.') / config.archive_dir / '{:%Y-%m-%d}'.format(at_time if at_time else datetime.now())
-    if not archive_dir.exists():
-        archive_dir.mkdir(parents=True)
-    return user.save(archive_dir / '{}.pkl'.format(user.id))
-
-
-def weighted_choice(choices):
-   total = sum(w for c, w in choices)
-   r = random.uniform(0, total)
-   upto = 0
-   for c, w in choices:
-      if upto + w >= r:
-         return c, w
-      upto += w
-   return choices[0] if len(choices) else False
+    day = '{:%Y-%m-%d}'.format(at_time if at_time else datetime.now())
+    return storage.profile_archive().put(user, day)
+
+
+# Weighted random choice of indices without replacement: a Fenwick tree over the weights gives O(log n) sampling
+# and removal. Negative weights count as zero; once only zero weights are left, the choice is uniform.
+class WeightedSampler:
+
+    def __init__(self, weights, rng=random):
+        self._weights = [max(float(w), 0.0) for w in weights]
+        self._n = len(self._weights)
+        self._tree = [0.0] * (self._n + 1)
+        for i, w in enumerate(self._weights, 1):
+            self._tree[i] += w
+            parent = i + (i & -i)
+            if parent <= self._n:
+                self._tree[parent] += self._tree[i]
+        self._remaining = set(range(self._n))
+        self._rng = rng
+
+    def __len__(self):
+        return len(self._remaining)
+
+    def _total(self):
+        total, i = 0.0, self._n
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def remove(self, index):
+        if index not in self._remaining:
+            return
+        self._remaining.discard(index)
+        delta, self._weights[index] = -self._weights[index], 0.0
+        i = index + 1
+        while i <= self._n:
+            self._tree[i] += delta
+            i += i & -i
+
+    def sample(self):
+        # Index of a remaining weight, chosen with probability proportional to it
+        if not self._remaining:
+            raise IndexError('sample from an empty sampler')
+        total = self._total()
+        if total > 0:
+            # Descend the tree to the first index whose prefix sum exceeds r
+            r = self._rng.random() * total
+            pos, step = 0, 1 << self._n.bit_length()
+            while step:
+                if pos + step <= self._n and self._tree[pos + step] <= r:
+                    pos += step
+                    r -= self._tree[pos]
+                step >>= 1
+            if pos < self._n and self._weights[pos] > 0:
+                return pos
+        # Only zero weights left (or rounding pushed r past the last one)
+        return self._rng.choice(sorted(self._remaining))
+
+
+def memory_usage():
+    # Resident and peak resident set size of the current process in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize(), peak
+    except OSError:
+        return peak, peak
+
+
+class CountingLRUCache(LRUCache):
+    evictions = 0
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
 
 
 class NonLogger:
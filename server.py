@@ -1,4 +1,5 @@
 import os
+import time
 from datetime import datetime
 import flask, json
 import rollbar
@@ -9,6 +10,13 @@ def json_response(data, http_code=200):
     return flask.make_response(flask.jsonify(data), http_code)
 
 app = flask.Flask(__name__)
+started_at = time.time()
+
+@app.before_first_request
+def log_startup():
+    rss, peak = recommender.utils.memory_usage()
+    app.logger.info('First request %.2fs after start (pid %d, RSS %.1f MB, peak %.1f MB)',
+                    time.time() - started_at, os.getpid(), rss / 2**20, peak / 2**20)
 
 @app.before_first_request
 def init_rollbar():
@@ -61,17 +69,46 @@ def default_route():
     return json_response({'status': 'ok'})
 
 
+@app.route('/stats/')
+def get_stats():
+    rss, peak = recommender.utils.memory_usage()
+    return json_response({
+        'pid': os.getpid(),
+        'uptime': time.time() - started_at,
+        'memory': {'rss': rss, 'peak': peak},
+        'models': recommender.models.stats(),
+        'question_store': recommender.features.question_store().stats(),
+        'profile_cache': recommender.profile_cache_stats(),
+        'db_pool': recommender.db.stats(),
+        'candidate_pools': recommender.pools.stats(),
+        'background': recommender.background.stats(),
+        'match_archive': recommender.match_archive.stats(),
+    })
+
+
+section_mode_map = {
+    'hot-questions':       ('questions', 'interests'),
+    'useful-questions':    ('questions', 'interests'),
+    'awaiting-answer':     ('questions', 'expertise'),
+    'popular-unanswered':  ('questions', 'expertise'),
+    'highly-discussed-qs': ('questions', 'both'),
+    'highly-discussed-as': ('answers',   'both'),
+    'interesting-answers': ('answers',   'both'),
+}
+
+
+def get_recommender_type():
+    # Choose recommender in A/B test based on date
+    _, week, day = datetime.now().isocalendar()
+    week_even = week % 2 == 0
+    if (week_even and day > 3) or (not week_even and day <= 3):
+        return 'diverse'
+    else:
+        return 'personalized'
+
+
 @app.route('/recommend/<string:section>/')
 def get_recommendations(section):
-    section_mode_map = {
-        'hot-questions':       ('questions', 'interests'),
-        'useful-questions':    ('questions', 'interests'),
-        'awaiting-answer':     ('questions', 'expertise'),
-        'popular-unanswered':  ('questions', 'expertise'),
-        'highly-discussed-qs': ('questions', 'both'),
-        'highly-discussed-as': ('answers',   'both'),
-        'interesting-answers': ('answers',   'both'),
-    }
     if section not in section_mode_map.keys():
         return flask.abort(404)
 
@@ -80,19 +117,12 @@ def get_recommendations(section):
         user_id = int(args['user_id'])
         frequency = args['frequency']
         duplicates = json.loads(args.get('duplicates', '{}'))
-    except ValueError or KeyError:
+    except (ValueError, KeyError):
         return flask.abort(400)
 
     app.logger.info('GET recommendations - user: %s, section: %s, freq: %s', user_id, section, frequency)
 
-    # Choose recommender in A/B test based on date
-    _, week, day = datetime.now().isocalendar()
-    week_even = week % 2 == 0
-    if (week_even and day > 3) or (not week_even and day <= 3):
-        rec_type = 'diverse'
-    else:
-        rec_type = 'personalized'
-
+    rec_type = get_recommender_type()
     rec_mode = section_mode_map[section]
     results = recommender.recommend(rec_type, section, rec_mode, frequency, user_id, duplicates, logger=app.logger)
 
@@ -100,6 +130,35 @@ def get_recommendations(section):
     return json_response(results)
 
 
+@app.route('/recommend/batch', methods=['POST'])
+def get_batch_recommendations():
+    # Body: {"user_id", "frequency", "sections": [...], "duplicates": {...}} or {"users": [<such objects>]},
+    # optionally with "limit" (results per section, also the ones excluded from the following sections)
+    try:
+        body = flask.request.get_json(force=True)
+        limit = int(body.get('limit', recommender.rec_lst_size))
+        batch = [(int(r['user_id']), r['frequency'], list(r['sections']), dict(r.get('duplicates', {})))
+                    for r in body.get('users', [body])]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return flask.abort(400)
+
+    unknown = {section for _, _, sections, _ in batch for section in sections} - set(section_mode_map)
+    if unknown:
+        return flask.abort(400, 'Unknown sections: {}'.format(', '.join(sorted(unknown))))
+
+    rec_type = get_recommender_type()
+    results = []
+    for user_id, frequency, sections, duplicates in batch:
+        app.logger.info('POST batch recommendations - user: %s, sections: %d, freq: %s', user_id, len(sections), frequency)
+        results.append({
+            'user_id': user_id,
+            'recommendations': recommender.recommend_batch(rec_type, [(s, section_mode_map[s]) for s in sections],
+                                                           frequency, user_id, duplicates, limit, logger=app.logger),
+        })
+
+    return json_response(results if 'users' in body else results[0]['recommendations'])
+
+
 @app.teardown_appcontext
 def close_db(_):
     app.logger.debug('Closing DB connection (App context teardown)')